@@ -31,8 +31,10 @@ def run_shell_command():
 @pytest.fixture(autouse=True)
 def clear_cache_file():
     # Remove cache file before each test
-    if os.path.exists(CACHE_FILE):
-        os.remove(CACHE_FILE)
+    for path in (CACHE_FILE, f"{CACHE_FILE}.lock"):
+        if os.path.exists(path):
+            os.remove(path)
     yield
-    if os.path.exists(CACHE_FILE):
-        os.remove(CACHE_FILE)
\ No newline at end of file
+    for path in (CACHE_FILE, f"{CACHE_FILE}.lock"):
+        if os.path.exists(path):
+            os.remove(path)
\ No newline at end of file
@@ -0,0 +1,134 @@
+"""Asynchronous versions of the functions that interact with the Postcode API."""
+
+import asyncio
+import time
+import weakref
+import postcode_functions as sync
+from postcode_functions import (cache_lookup, check_location, check_string,
+                                check_string_list, complete_locally, fetch_completions,
+                                fetch_nearest, fetch_remembering_errors, fetch_validation,
+                                get_cache_store, get_location_cache, locate_locally,
+                                raise_recent_error, refresh_completions,
+                                refresh_in_background, refresh_validation, validate_offline)
+from postcode_index import canonical, matches_format
+
+MAX_CONCURRENCY = 20
+REFRESHERS = {'valid': refresh_validation, 'completions': refresh_completions}
+
+
+class AsyncPostcodeClient:
+    """Runs blocking API calls in worker threads, at most max_concurrency at a time.
+
+    Cache reads and writes are serialised with an asyncio lock, so coroutines share the
+    same cache store as the synchronous functions."""
+
+    def __init__(self, max_concurrency: int = MAX_CONCURRENCY):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.cache_lock = asyncio.Lock()
+
+    async def _call(self, function, *args):
+        """Runs a blocking function in a thread once a concurrency slot is free."""
+        async with self.semaphore:
+            return await asyncio.to_thread(function, *args)
+
+    async def _cached(self, key: str, field: str):
+        """Returns the cache entry for a key if its field can be served, under the cache lock.
+
+        The store is read in a worker thread, so a slow read doesn't block the event loop.
+
+        Stale fields are returned too, and refreshed in the background. A recent API error
+        for the field is raised again."""
+        async with self.cache_lock:
+            entry = await asyncio.to_thread(get_cache_store().get, key)
+        state = cache_lookup(entry, field)
+        if state == 'stale':
+            refresh_in_background(field, [key], lambda keys: REFRESHERS[field](keys[0]))
+        if state in ('fresh', 'stale'):
+            return entry
+        raise_recent_error(entry, field)
+        return None
+
+    async def _store(self, key: str, fields: dict):
+        """Merges fields into the cache under the cache lock."""
+        async with self.cache_lock:
+            await asyncio.to_thread(get_cache_store().update, key, fields)
+
+    async def validate_postcode(self, postcode: str) -> bool:
+        """Returns a boolean as a check for valid postcodes."""
+        check_string(postcode)
+        key, known = validate_offline(postcode)
+        if known is not None:
+            return known
+        entry = await self._cached(key, 'valid')
+        if entry:
+            return entry['valid']
+        result = await self._call(fetch_remembering_errors, 'valid', key, fetch_validation)
+        await self._store(key, {'valid': result, 'valid_at': time.time()})
+        return result
+
+    async def get_postcode_for_location(self, lat: float, long: float) -> str:
+        """Returns a postcode based on longitudinal and latitudinal location."""
+        check_location(lat, long)
+        async with self.cache_lock:
+            postcode = await asyncio.to_thread(
+                lambda: locate_locally(lat, long) or get_location_cache().get(lat, long))
+        if postcode:
+            return postcode
+        results = await self._call(fetch_nearest, lat, long)
+        async with self.cache_lock:
+            await asyncio.to_thread(get_location_cache().put, lat, long, results)
+        return results[0]['postcode']
+
+    async def get_postcode_completions(self, postcode_start: str) -> list[str]:
+        """Returns a full postcode based on the beginning of a known postcode."""
+        check_string(postcode_start)
+        if not matches_format(postcode_start):
+            return None
+        key = canonical(postcode_start)
+        entry = await self._cached(key, 'completions')
+        if entry:
+            return entry['completions']
+        async with self.cache_lock:
+            local = await asyncio.to_thread(complete_locally, key)
+        if local is not False:
+            return local
+        result = await self._call(fetch_remembering_errors, 'completions', key,
+                                  fetch_completions)
+        await self._store(key, {'completions': result, 'completions_at': time.time()})
+        return result
+
+    async def get_postcodes_details(self, postcodes: list[str]) -> dict:
+        """Returns the details of given list of postcodes."""
+        check_string_list(postcodes)
+        return await self._call(sync.get_postcodes_details, postcodes)
+
+
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_client() -> AsyncPostcodeClient:
+    """Returns the shared client for the running event loop."""
+    loop = asyncio.get_running_loop()
+    if loop not in _clients:
+        _clients[loop] = AsyncPostcodeClient()
+    return _clients[loop]
+
+
+async def validate_postcode(postcode: str) -> bool:
+    """Returns a boolean as a check for valid postcodes."""
+    return await get_client().validate_postcode(postcode)
+
+
+async def get_postcode_for_location(lat: float, long: float) -> str:
+    """Returns a postcode based on longitudinal and latitudinal location."""
+    return await get_client().get_postcode_for_location(lat, long)
+
+
+async def get_postcode_completions(postcode_start: str) -> list[str]:
+    """Returns a full postcode based on the beginning of a known postcode."""
+    return await get_client().get_postcode_completions(postcode_start)
+
+
+async def get_postcodes_details(postcodes: list[str]) -> dict:
+    """Returns the details of given list of postcodes."""
+    return await get_client().get_postcodes_details(postcodes)
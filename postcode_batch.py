@@ -0,0 +1,165 @@
+"""Validates or details a large file of postcodes across several worker processes.
+
+Postcodes are partitioned by a hash of their outward code, one partition per worker,
+and each worker keeps its own SQLite cache shard seeded from the main cache, so workers
+never contend for a cache file. Results come back in input order, and the shards are
+merged into the main cache at the end."""
+
+import json
+import os
+import sys
+import zlib
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+import postcode_functions as functions
+from postcode_cache import (MemoryCacheStore, SqliteCacheStore, merge_entries,
+                            open_cache_store)
+from postcode_client import API_URL, PostcodeClient, TokenBucket
+from postcode_index import canonical
+
+MODES = ("validate", "details")
+CHUNK_SIZE = functions.BULK_LIMIT * functions.BULK_WORKERS
+
+
+def shard_of(postcode: str, shards: int) -> int:
+    """Returns the shard a postcode belongs to, the same in every process."""
+    outward = canonical(postcode).split(" ", maxsplit=1)[0]
+    return zlib.crc32(outward.encode()) % shards
+
+
+def shard_paths(cache_path: str, shards: int) -> list[str]:
+    """Returns the paths of the cache shards kept next to a cache file."""
+    return [f"{cache_path}.shard{i}" for i in range(shards)]
+
+
+def split_cache(cache_path: str, paths: list[str]):
+    """Writes the postcode entries of a cache into shards, replacing their contents."""
+    store = open_cache_store(cache_path)
+    cache = store.load()
+    if isinstance(store, SqliteCacheStore):
+        store.close()
+    shards = [{} for _ in paths]
+    for key, entry in cache.items():
+        if not key.startswith("@"):
+            shards[shard_of(key, len(paths))][key] = entry
+    for path, shard in zip(paths, shards):
+        target = SqliteCacheStore(path)
+        target.save(shard)
+        target.close()
+
+
+def merge_cache_shards(paths: list[str], cache_path: str) -> int:
+    """Merges cache shards into a cache file, then deletes them.
+
+    Where both have a field, the newer value is kept. Returns the number of entries
+    merged."""
+    store = open_cache_store(cache_path)
+    merged = {}
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        shard = SqliteCacheStore(path)
+        merged.update(shard.load())
+        shard.close()
+    cache = store.load()
+    store.update_many({key: merge_entries([cache.get(key) or {}, entry])
+                       for key, entry in merged.items()})
+    store.flush()
+    if isinstance(store, SqliteCacheStore):
+        store.close()
+    for path in paths:
+        if os.path.exists(path):
+            os.unlink(path)
+    return len(merged)
+
+
+def start_worker(base_url: str, rate: float | None):
+    """Gives a worker process its own API client, with its share of the rate limit."""
+    functions.set_client(PostcodeClient(base_url, rate_limiter=TokenBucket(rate)))
+
+
+def process_shard(path: str, mode: str, postcodes: list[str]) -> list:
+    """Looks up a shard's postcodes against its own cache, returning results in order."""
+    functions.set_cache_store(MemoryCacheStore(SqliteCacheStore(path)))
+    results = []
+    try:
+        for start in range(0, len(postcodes), CHUNK_SIZE):
+            chunk = postcodes[start:start + CHUNK_SIZE]
+            if mode == "validate":
+                valid = functions.validate_postcodes(chunk)
+                results += [valid[postcode] for postcode in chunk]
+            else:
+                response = functions.get_postcodes_details(chunk)
+                results += [item['result'] for item in response['result']]
+    finally:
+        functions.get_cache_store().backing.close()
+        functions.set_cache_store(None)
+    return results
+
+
+def partition(postcodes: list[str], shards: int) -> list[list[int]]:
+    """Returns the input positions of the postcodes in each shard."""
+    positions = [[] for _ in range(shards)]
+    for i, postcode in enumerate(postcodes):
+        positions[shard_of(postcode, shards)].append(i)
+    return positions
+
+
+def run_sharded(postcodes: list[str], mode: str = "validate",  # pylint: disable=too-many-arguments
+                workers: int | None = None, *, cache_path: str = functions.CACHE_FILE,
+                rate: float | None = None, base_url: str = API_URL) -> list:
+    """Looks up postcodes in worker processes, returning their results in input order.
+
+    rate, in requests per second, is shared evenly between the workers, so each may get
+    less than one request per second."""
+    if rate is not None and rate <= 0:
+        raise ValueError("The rate limit must be positive.")
+    workers = workers or os.cpu_count() or 1
+    paths = shard_paths(cache_path, workers)
+    split_cache(cache_path, paths)
+    results = [None] * len(postcodes)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=start_worker,
+                                 initargs=(base_url, rate / workers if rate else None)
+                                 ) as executor:
+            futures = {executor.submit(process_shard, path, mode,
+                                       [postcodes[i] for i in positions]): positions
+                       for path, positions in zip(paths, partition(postcodes, workers))
+                       if positions}
+            for future, positions in futures.items():
+                for i, result in zip(positions, future.result()):
+                    results[i] = result
+    finally:
+        merge_cache_shards(paths, cache_path)
+    return results
+
+
+def main():
+    """Runs a batch from the command line, writing JSON Lines in input order."""
+    parser = ArgumentParser(description="Look up a file of postcodes in parallel processes.")
+    parser.add_argument("input", help="A file of postcodes, one per line ('-' for stdin).")
+    parser.add_argument("--mode", "-m", choices=MODES, default="validate",
+                        help="Validate the postcodes or fetch their details.")
+    parser.add_argument("--workers", "-w", type=int, default=os.cpu_count(),
+                        help="Worker processes, and so cache shards.")
+    parser.add_argument("--rate", type=float,
+                        help="The API rate limit, in requests per second across all workers.")
+    parser.add_argument("--cache", default=functions.CACHE_FILE,
+                        help="The cache file to seed the shards from and merge them into.")
+    args = parser.parse_args()
+    if args.input == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(args.input, "r", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+    postcodes = [line.strip() for line in lines if line.strip()]
+    field = "valid" if args.mode == "validate" else "details"
+    results = run_sharded(postcodes, args.mode, args.workers, cache_path=args.cache,
+                          rate=args.rate)
+    for postcode, result in zip(postcodes, results):
+        sys.stdout.write(json.dumps({"postcode": postcode, field: result}) + "\n")
+
+
+if __name__ == "__main__":
+    main()
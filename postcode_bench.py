@@ -0,0 +1,176 @@
+"""Benchmarks for the postcode client against a local stub API."""
+
+import json
+import os
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import requests as req
+
+import postcode_functions as functions
+from postcode_cache import JsonCacheStore, MemoryCacheStore, SqliteCacheStore
+from postcode_client import PostcodeClient
+from postcode_stub import StubServer, make_locations, make_postcodes
+
+CACHE_SIZES = (1_000, 10_000, 100_000)
+STORES = {"json": JsonCacheStore, "sqlite": SqliteCacheStore}
+
+
+def measure(function, calls: int, per_call: int = 1) -> dict:
+    """Calls a function repeatedly, returning its throughput and latency percentiles.
+
+    Throughput counts per_call operations for each call, so batch functions are
+    reported in postcodes per second."""
+    timings = []
+    start = time.perf_counter()
+    for i in range(calls):
+        began = time.perf_counter()
+        function(i)
+        timings.append(time.perf_counter() - began)
+    elapsed = time.perf_counter() - start
+    timings.sort()
+    return {"calls": calls,
+            "ops_per_sec": calls * per_call / elapsed,
+            "mean_ms": statistics.mean(timings) * 1000,
+            "p50_ms": timings[len(timings) // 2] * 1000,
+            "p99_ms": timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1000}
+
+
+def bench_connections(calls: int, latency: float) -> dict:
+    """Compares a fresh connection per call with the pooled PostcodeClient."""
+    postcodes = make_postcodes(1000)
+    with StubServer(postcodes, latency=latency) as server:
+        client = PostcodeClient(base_url=server.url)
+        results = {
+            "new_connection": measure(
+                lambda i: req.get(f"{server.url}/postcodes/{postcodes[i % 1000]}/validate",
+                                  timeout=10), calls),
+            "pooled_session": measure(
+                lambda i: client.get(f"/postcodes/{postcodes[i % 1000]}/validate"), calls),
+        }
+        client.close()
+    return results
+
+
+def benchmarks(postcodes: list[str], batch_size: int) -> dict:
+    """Returns the single and batch calls to time, as (mode, function, per_call) by name.
+
+    Each function takes a call number and looks up different postcodes for each one."""
+    locations = make_locations(postcodes)
+    count = len(postcodes)
+
+    def batch(i: int) -> list[str]:
+        start = i * batch_size % count
+        return postcodes[start:start + batch_size]
+
+    return {
+        "validate_postcode": (
+            "single", lambda i: functions.validate_postcode(postcodes[i % count]), 1),
+        "get_postcode_completions": (
+            "single", lambda i: functions.get_postcode_completions(postcodes[i % count][:-1]),
+            1),
+        "get_postcode_for_location": (
+            "single",
+            lambda i: functions.get_postcode_for_location(*locations[postcodes[i % count]]), 1),
+        "get_postcodes_details": (
+            "single", lambda i: functions.get_postcodes_details([postcodes[i % count]]), 1),
+        "validate_postcodes": (
+            "batch", lambda i: functions.validate_postcodes(batch(i)), batch_size),
+        "get_postcodes_details_batch": (
+            "batch", lambda i: functions.get_postcodes_details(batch(i)), batch_size),
+        "get_postcodes_for_locations": (
+            "batch", lambda i: functions.get_postcodes_for_locations(
+                [locations[postcode] for postcode in batch(i)]), batch_size),
+    }
+
+
+def fill_cache(path: str, store: str, size: int, skip: int):
+    """Writes a cache file holding size validated postcodes, none of the first skip."""
+    now = time.time()
+    filler = make_postcodes(size + skip)[skip:]
+    STORES[store](path).save({postcode: {"valid": True, "valid_at": now}
+                              for postcode in filler})
+
+
+def bench_cache_size(postcodes: list[str], size: int, store: str, calls: int,
+                     batch_size: int) -> list[dict]:
+    """Times each public function, cold then warm, with a cache of a given size."""
+    results = []
+    directory = tempfile.mkdtemp()
+    try:
+        template = os.path.join(directory, "template")
+        fill_cache(template, store, size, len(postcodes))
+        for name, (mode, function, per_call) in benchmarks(postcodes, batch_size).items():
+            path = os.path.join(directory, name)
+            shutil.copyfile(template, path)
+            functions.set_cache_store(MemoryCacheStore(STORES[store](path)))
+            for cache in ("cold", "warm"):
+                timings = measure(function, calls if mode == "single" else max(1, calls // 10),
+                                  per_call)
+                results.append({"function": name, "mode": mode, "cache_size": size,
+                                "cache": cache, **timings})
+    finally:
+        functions.set_cache_store(None)
+        shutil.rmtree(directory)
+    return results
+
+
+def bench_functions(calls: int, latency: float, cache_sizes=CACHE_SIZES,
+                    store: str = "json", batch_size: int = 100) -> list[dict]:
+    """Times each public function against the stub API at several cache sizes.
+
+    For every size, each function starts from a copy of a cache file holding that many
+    unrelated entries. The first pass over its postcodes misses the cache and calls the
+    API; the second pass repeats the same lookups against the now warm cache. Batch
+    functions make a tenth as many calls. The client is unthrottled, so the numbers
+    measure the code rather than the rate limiter."""
+    postcodes = make_postcodes(max(calls, max(1, calls // 10) * batch_size))
+    results = []
+    with StubServer(postcodes, latency=latency) as server:
+        client = PostcodeClient(base_url=server.url)
+        functions.set_client(client)
+        try:
+            for size in cache_sizes:
+                results += bench_cache_size(postcodes, size, store, calls, batch_size)
+        finally:
+            functions.set_client(None)
+            client.close()
+    return results
+
+
+def main():
+    """Runs the benchmarks and writes the results as JSON."""
+    parser = ArgumentParser()
+    parser.add_argument("--calls", type=int, default=200,
+                        help="Calls per measurement; batch functions make a tenth as many.")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Artificial server latency in seconds.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(CACHE_SIZES),
+                        help="Cache sizes to measure, in entries.")
+    parser.add_argument("--store", choices=list(STORES), default="json",
+                        help="The cache store behind the in-memory LRU.")
+    parser.add_argument("--batch-size", type=int, default=functions.BULK_LIMIT,
+                        help="Postcodes per batch call.")
+    parser.add_argument("--output", "-o", help="Write the results to this JSON file.")
+    args = parser.parse_args()
+    report = {
+        "started_at": time.time(),
+        "python": platform.python_version(),
+        "settings": vars(args),
+        "connections": bench_connections(args.calls, args.latency),
+        "functions": bench_functions(args.calls, args.latency, args.sizes, args.store,
+                                     args.batch_size),
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
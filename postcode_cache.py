@@ -0,0 +1,958 @@
+"""Storage backends for the postcode cache."""
+
+import atexit
+import os
+import sys
+import json
+import math
+import struct
+import tempfile
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import postcode_metrics as metrics
+from postcode_geo import distance
+from postcode_index import canonical
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+COMPACT_MAGIC = b"PCCACHE\x00"
+COMPACT_VERSION = 1
+COMPACT_HEADER = struct.Struct("<8sHHIIIIII")
+SQLITE_MAGIC = b"SQLite format 3\x00"
+
+
+class CacheStore:
+    """Key-value storage for cache entries shaped like {postcode: {"valid", "completions"}}."""
+
+    def get(self, key: str) -> dict | None:
+        """Returns the entry stored under a key, or None if there isn't one."""
+        raise NotImplementedError
+
+    def update(self, key: str, fields: dict):
+        """Merges fields into the entry stored under a key."""
+        self.update_many({key: fields})
+
+    def update_many(self, entries: dict):
+        """Merges fields into several entries at once."""
+        raise NotImplementedError
+
+    def delete_many(self, keys):
+        """Removes several entries at once."""
+        raise NotImplementedError
+
+    def load(self) -> dict:
+        """Returns every entry in the store as a dictionary."""
+        raise NotImplementedError
+
+    def save(self, cache: dict):
+        """Replaces the contents of the store with a dictionary."""
+        raise NotImplementedError
+
+    def generation(self):
+        """Returns a value that changes whenever another process modifies the store."""
+        return None
+
+    def flush(self):
+        """Persists any writes the store has buffered."""
+
+
+class JsonCacheStore(CacheStore):
+    """Stores the cache as a single JSON file, rewriting it on every update.
+
+    Writers hold an advisory lock on a sibling .lock file, re-read the file and merge
+    their changes into it, then atomically replace it, so concurrent processes neither
+    lose each other's entries nor expose a half-written file to readers. Reads parse the
+    file once per generation and look keys up in the parsed dictionary."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._parsed = (None, None)
+        self._parsed_lock = threading.Lock()
+
+    @contextmanager
+    def locked(self):
+        """Holds an exclusive lock on the cache file for the duration of a block."""
+        with open(f"{self.path}.lock", "a", encoding="utf-8") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def parsed(self) -> dict:
+        """Returns the parsed file, re-reading it only if it has changed."""
+        with self._parsed_lock:
+            generation = self.generation()
+            if generation is None:
+                return {}
+            if self._parsed[0] != generation:
+                self._parsed = (generation, self.load())
+            return self._parsed[1]
+
+    def get(self, key: str) -> dict | None:
+        """Returns the entry stored under a key, or None if there isn't one."""
+        return self.parsed().get(key)
+
+    def update_many(self, entries: dict):
+        """Merges fields into several entries at once."""
+        with self.locked():
+            cache = self.load()
+            for key, fields in entries.items():
+                cache.setdefault(key, {}).update(fields)
+            self._write(cache)
+
+    def delete_many(self, keys):
+        """Removes several entries at once."""
+        with self.locked():
+            cache = self.load()
+            for key in keys:
+                cache.pop(key, None)
+            self._write(cache)
+
+    def load(self) -> dict:
+        """Reads the JSON file, returning an empty dictionary if it doesn't exist."""
+        try:
+            with metrics.timed("cache_read"), open(self.path, "r", encoding="utf-8") as f:
+                text = f.read()
+        except FileNotFoundError:
+            return {}
+        metrics.count("cache_bytes_read", len(text))
+        with metrics.timed("cache_parse"):
+            return json.loads(text)
+
+    def save(self, cache: dict):
+        """Writes the whole cache to the JSON file."""
+        with self.locked():
+            self._write(cache)
+
+    def _write(self, cache: dict):
+        """Writes the cache to a temporary file and moves it over the JSON file."""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        descriptor, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with metrics.timed("cache_write"):
+                with os.fdopen(descriptor, "w", encoding="utf-8") as f:
+                    json.dump(cache, f)
+                    metrics.count("cache_bytes_written", f.tell())
+                os.replace(temporary, self.path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+    def generation(self):
+        """Returns the file's identity and modification time, or None if it doesn't exist."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns)
+
+
+def _bits(flags: list[bool]) -> bytes:
+    """Packs booleans into a bitfield, least significant bit first."""
+    packed = bytearray((len(flags) + 7) // 8)
+    for i, flag in enumerate(flags):
+        if flag:
+            packed[i >> 3] |= 1 << (i & 7)
+    return bytes(packed)
+
+
+def _bit(bitfield: bytes, i: int) -> bool:
+    """Returns one flag from a bitfield."""
+    return bool(bitfield[i >> 3] >> (i & 7) & 1)
+
+
+_BYTE_BITS = [tuple(bool(byte >> bit & 1) for bit in range(8)) for byte in range(256)]
+
+
+def _unpack_bits(bitfield: bytes, count: int) -> list[bool]:
+    """Unpacks the first count flags of a bitfield."""
+    return [flag for byte in bitfield for flag in _BYTE_BITS[byte]][:count]
+
+
+def _set_bits(bitfield: bytes, count: int):
+    """Yields the positions of the set flags in a bitfield."""
+    for position, byte in enumerate(bitfield):
+        if byte:
+            for bit in range(8):
+                if byte >> bit & 1 and position * 8 + bit < count:
+                    yield position * 8 + bit
+
+
+def _little_endian(values: array) -> bytes:
+    """Returns an array's contents as little-endian bytes."""
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_little_endian(typecode: str, data) -> array:
+    """Reads an array from little-endian bytes."""
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+def _timestamp(value) -> bool:
+    """Returns whether a value can be stored in a timestamp column."""
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _split_entry(entry: dict) -> tuple[dict, dict]:
+    """Splits an entry into the fields with a column of their own and the rest."""
+    columns, extras = {}, {}
+    for field, value in entry.items():
+        if field == "valid" and isinstance(value, bool):
+            columns[field] = value
+        elif field in ("valid_at", "completions_at") and _timestamp(value):
+            columns[field] = float(value)
+        elif field == "completions" and (value is None or isinstance(value, list) and all(
+                isinstance(item, str) and "\x00" not in item for item in value)):
+            columns[field] = value
+        else:
+            extras[field] = value
+    return columns, extras
+
+
+def _completion_columns(columns: list[dict], strings: dict) -> list[bytes]:
+    """Returns each key's offset into the completion indices, and the indices themselves."""
+    offsets, indices = array("I", [0]), array("I")
+    for fields in columns:
+        indices.extend(strings[item] for item in fields.get("completions") or ())
+        offsets.append(len(indices))
+    return [_little_endian(offsets), _little_endian(indices)]
+
+
+def _extras_columns(extras: list[dict]) -> list[bytes]:
+    """Returns each key's offset into the JSON of its other fields, and the JSON itself."""
+    offsets, blobs = array("I", [0]), []
+    for fields in extras:
+        if fields:
+            blobs.append(json.dumps(fields).encode("utf-8"))
+            offsets.append(offsets[-1] + len(blobs[-1]))
+        else:
+            offsets.append(offsets[-1])
+    return [_little_endian(offsets), b"".join(blobs)]
+
+
+def encode_compact(cache: dict) -> bytes:
+    """Returns a cache in the compact binary format.
+
+    Keys are sorted and stored first in a table of NUL-separated strings, followed by every
+    other string used in a completion list, each stored once. Each key's valid flag and
+    whether it has completions are bitfields, its timestamps are float64 columns (NaN when
+    absent) and its completions are indices into the string table. Fields without a column
+    are stored per key as JSON, and entries whose keys contain NUL as one JSON object."""
+    overflow = {key: entry for key, entry in cache.items() if "\x00" in key}
+    keys = sorted(key for key in cache if key not in overflow)
+    columns, extras = zip(*(_split_entry(cache[key] or {}) for key in keys)) if keys else ((), ())
+    strings = {key: i for i, key in enumerate(keys)}
+    for fields in columns:
+        for item in fields.get("completions") or ():
+            strings.setdefault(item, len(strings))
+    completions = _completion_columns(columns, strings)
+    sections = [
+        _bits(["valid" in fields for fields in columns]),
+        _bits([fields.get("valid", False) for fields in columns]),
+        _bits(["completions" in fields for fields in columns]),
+        _bits([fields.get("completions", []) is None for fields in columns]),
+        _little_endian(array("d", (fields.get("valid_at", math.nan) for fields in columns))),
+        _little_endian(array("d", (fields.get("completions_at", math.nan) for fields in columns))),
+        *completions, *_extras_columns(extras),
+        "\x00".join(strings).encode("utf-8"),
+        json.dumps(overflow).encode("utf-8") if overflow else b""]
+    header = COMPACT_HEADER.pack(COMPACT_MAGIC, COMPACT_VERSION, 0, len(keys), len(strings),
+                                 len(completions[1]) // 4, len(sections[-3]), len(sections[-2]),
+                                 len(sections[-1]))
+    return header + b"".join(sections)
+
+
+class CompactSnapshot:  # pylint: disable=too-many-instance-attributes
+    """The decoded columns of a compact cache file, from which entries are built on demand."""
+
+    def __init__(self, data: bytes):
+        (magic, version, _, count, string_count, index_count, extras_size, table_size,
+         overflow_size) = COMPACT_HEADER.unpack_from(data)
+        if magic != COMPACT_MAGIC or version != COMPACT_VERSION:
+            raise ValueError("Not a compact cache file of a supported version.")
+        view = memoryview(data)
+        position = COMPACT_HEADER.size
+
+        def take(size: int):
+            nonlocal position
+            position += size
+            return view[position - size:position]
+
+        bitfield = (count + 7) // 8
+        self.count = count
+        self.valid_present, self.valid, self.completions_present, self.completions_none = (
+            bytes(take(bitfield)) for _ in range(4))
+        self.valid_at = _from_little_endian("d", take(count * 8))
+        self.completions_at = _from_little_endian("d", take(count * 8))
+        self.offsets = _from_little_endian("I", take((count + 1) * 4))
+        self.indices = _from_little_endian("I", take(index_count * 4))
+        self.extras_offsets = _from_little_endian("I", take((count + 1) * 4))
+        self.extras = bytes(take(extras_size))
+        self.strings = str(take(table_size), "utf-8").split("\x00") if string_count else []
+        self.overflow = json.loads(bytes(take(overflow_size))) if overflow_size else {}
+
+    def entry(self, i: int) -> dict:
+        """Builds the entry stored at a position in the key table."""
+        entry = {}
+        if _bit(self.valid_present, i):
+            entry["valid"] = _bit(self.valid, i)
+        if not math.isnan(self.valid_at[i]):
+            entry["valid_at"] = self.valid_at[i]
+        if _bit(self.completions_present, i):
+            strings = self.strings
+            entry["completions"] = None if _bit(self.completions_none, i) else [
+                strings[j] for j in self.indices[self.offsets[i]:self.offsets[i + 1]]]
+        if not math.isnan(self.completions_at[i]):
+            entry["completions_at"] = self.completions_at[i]
+        start, end = self.extras_offsets[i], self.extras_offsets[i + 1]
+        if start != end:
+            entry.update(json.loads(self.extras[start:end]))
+        return entry
+
+    def get(self, key: str) -> dict | None:
+        """Returns the entry stored under a key, or None if there isn't one."""
+        if key in self.overflow:
+            return self.overflow[key]
+        i = bisect_left(self.strings, key, 0, self.count)
+        if i < self.count and self.strings[i] == key:
+            return self.entry(i)
+        return None
+
+    def load(self) -> dict:
+        """Returns every entry as a dictionary, decoding one column at a time."""
+        count, strings = self.count, self.strings
+        entries = [{} for _ in range(count)]
+        for entry, present, valid in zip(entries, _unpack_bits(self.valid_present, count),
+                                         _unpack_bits(self.valid, count)):
+            if present:
+                entry["valid"] = valid
+        for field, column in (("valid_at", self.valid_at),
+                              ("completions_at", self.completions_at)):
+            for entry, value in zip(entries, column):
+                if not math.isnan(value):
+                    entry[field] = value
+        nones = _unpack_bits(self.completions_none, count)
+        for i in _set_bits(self.completions_present, count):
+            entries[i]["completions"] = None if nones[i] else [
+                strings[j] for j in self.indices[self.offsets[i]:self.offsets[i + 1]]]
+        offsets = self.extras_offsets
+        for i in range(count):
+            if offsets[i] != offsets[i + 1]:
+                entries[i].update(json.loads(self.extras[offsets[i]:offsets[i + 1]]))
+        cache = dict(zip(strings[:count], entries))
+        cache.update(self.overflow)
+        return cache
+
+
+class CompactCacheStore(JsonCacheStore):
+    """Stores the cache as a single file in the compact binary format.
+
+    Like the JSON store, writers merge their changes under a lock and atomically replace
+    the file. Reads decode the file's columns once per generation and build only the
+    entries asked for, so a lookup doesn't parse the whole cache."""
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self._snapshot = (None, None)
+        self._snapshot_lock = threading.Lock()
+
+    def snapshot(self) -> CompactSnapshot | None:
+        """Returns the decoded file, re-reading it if it has changed, or None if missing."""
+        with self._snapshot_lock:
+            generation = self.generation()
+            if generation is None:
+                return None
+            if self._snapshot[0] != generation:
+                with metrics.timed("cache_read"), open(self.path, "rb") as f:
+                    data = f.read()
+                metrics.count("cache_bytes_read", len(data))
+                with metrics.timed("cache_parse"):
+                    self._snapshot = (generation, CompactSnapshot(data))
+            return self._snapshot[1]
+
+    def get(self, key: str) -> dict | None:
+        """Returns the entry stored under a key, or None if there isn't one."""
+        snapshot = self.snapshot()
+        return snapshot.get(key) if snapshot else None
+
+    def load(self) -> dict:
+        """Decodes the whole file, returning an empty dictionary if it doesn't exist."""
+        snapshot = self.snapshot()
+        return snapshot.load() if snapshot else {}
+
+    def _write(self, cache: dict):
+        """Writes the cache to a temporary file and moves it over the cache file."""
+        with metrics.timed("cache_write"):
+            data = encode_compact(cache)
+            directory = os.path.dirname(os.path.abspath(self.path))
+            descriptor, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            try:
+                with os.fdopen(descriptor, "wb") as f:
+                    f.write(data)
+                os.replace(temporary, self.path)
+            except BaseException:
+                os.unlink(temporary)
+                raise
+        metrics.count("cache_bytes_written", len(data))
+
+
+class SqliteCacheStore(CacheStore):
+    """Stores one row per cache key in SQLite, so reads and writes touch a single key.
+
+    The connection is shared between threads, so every use of it holds a lock."""
+
+    def __init__(self, path: str, migrate_from: str | None = None):
+        self.path = path
+        self.lock = threading.RLock()
+        import sqlite3  # pylint: disable=import-outside-toplevel
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, entry TEXT NOT NULL)")
+        self.connection.commit()
+        if migrate_from:
+            self.migrate(migrate_from)
+
+    def migrate(self, json_path: str):
+        """Copies entries from a JSON cache file, once, if this store is still empty."""
+        if not os.path.exists(json_path):
+            return
+        with self.lock:
+            if self.connection.execute("SELECT 1 FROM cache LIMIT 1").fetchone():
+                return
+            self.save(JsonCacheStore(json_path).load())
+
+    def get(self, key: str) -> dict | None:
+        """Returns the entry stored under a key, or None if there isn't one."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT entry FROM cache WHERE key = ?", (key,)).fetchone()
+        if not row:
+            return None
+        metrics.count("cache_bytes_read", len(row[0]))
+        return json.loads(row[0])
+
+    def update_many(self, entries: dict):
+        """Merges fields into several entries in a single transaction."""
+        with self.lock, self.connection:
+            for key, fields in entries.items():
+                entry = self.get(key) or {}
+                entry.update(fields)
+                text = json.dumps(entry)
+                metrics.count("cache_bytes_written", len(text))
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO cache (key, entry) VALUES (?, ?)", (key, text))
+
+    def delete_many(self, keys):
+        """Removes several entries in a single transaction."""
+        with self.lock, self.connection:
+            self.connection.executemany("DELETE FROM cache WHERE key = ?",
+                                        ((key,) for key in keys))
+
+    def load(self) -> dict:
+        """Returns every entry in the store as a dictionary."""
+        with self.lock:
+            rows = self.connection.execute("SELECT key, entry FROM cache").fetchall()
+        return {key: json.loads(entry) for key, entry in rows}
+
+    def save(self, cache: dict):
+        """Replaces the contents of the store with a dictionary."""
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM cache")
+            self.connection.executemany(
+                "INSERT INTO cache (key, entry) VALUES (?, ?)",
+                ((key, json.dumps(entry)) for key, entry in cache.items()))
+
+    def generation(self):
+        """Returns SQLite's data version, which changes when other connections commit."""
+        with self.lock:
+            return self.connection.execute("PRAGMA data_version").fetchone()[0]
+
+    def close(self):
+        """Closes the underlying database connection."""
+        with self.lock:
+            self.connection.close()
+
+
+STORE_FORMATS = {"json": JsonCacheStore, "compact": CompactCacheStore,
+                 "sqlite": SqliteCacheStore}
+
+
+def detect_format(path: str) -> str:
+    """Returns the format of a cache file from its first bytes, or "json" if it's missing."""
+    try:
+        with open(path, "rb") as f:
+            start = f.read(len(SQLITE_MAGIC))
+    except FileNotFoundError:
+        return "json"
+    if start.startswith(COMPACT_MAGIC):
+        return "compact"
+    if start.startswith(SQLITE_MAGIC):
+        return "sqlite"
+    return "json"
+
+
+def open_cache_store(path: str) -> CacheStore:
+    """Returns a store for a cache file in whichever format the file is in."""
+    return STORE_FORMATS[detect_format(path)](path)
+
+
+def convert_cache(source: str, destination: str, cache_format: str) -> int:
+    """Copies a cache file into another format, returning the number of entries.
+
+    The source's format is detected, and the destination may be the same path."""
+    store = open_cache_store(source)
+    cache = store.load()
+    if isinstance(store, SqliteCacheStore):
+        store.close()
+    if cache_format == "sqlite":
+        temporary = f"{destination}.tmp"
+        if os.path.exists(temporary):
+            os.unlink(temporary)
+        target = SqliteCacheStore(temporary)
+        target.save(cache)
+        target.close()
+        os.replace(temporary, destination)
+    else:
+        STORE_FORMATS[cache_format](destination).save(cache)
+    return len(cache)
+
+
+def merge_entries(entries: list[dict]) -> dict:
+    """Merges cache entries for the same postcode, keeping the newest value of each field.
+
+    A field's age comes from its "<field>_at" timestamp; fields without one count as
+    older than any that have one."""
+    merged = {}
+    for entry in entries:
+        for field, value in entry.items():
+            if field.endswith("_at") and field[:-3] in entry:
+                continue
+            stamp = entry.get(f"{field}_at")
+            if field in merged and (stamp or 0) < merged.get(f"{field}_at", 0):
+                continue
+            merged[field] = value
+            if stamp is not None:
+                merged[f"{field}_at"] = stamp
+    return merged
+
+
+def compact_cache(path: str) -> tuple[int, int]:
+    """Merges entries whose keys are spellings of the same postcode, in place.
+
+    Keys are rewritten in their canonical form; location entries are left alone.
+    Returns the number of entries before and after."""
+    store = open_cache_store(path)
+    cache = store.load()
+    groups = {}
+    for key, entry in cache.items():
+        groups.setdefault(key if key.startswith("@") else canonical(key), []).append(entry)
+    if list(groups) != list(cache):
+        store.save({key: merge_entries(entries) for key, entries in groups.items()})
+    if isinstance(store, SqliteCacheStore):
+        store.close()
+    return len(cache), len(groups)
+
+
+def _entry_size(key: str, entry: dict | None) -> int:
+    """Estimates the memory used by a cache entry in bytes."""
+    size = sys.getsizeof(key) + sys.getsizeof(entry)
+    for field, value in (entry or {}).items():
+        size += sys.getsizeof(field) + sys.getsizeof(value)
+        if isinstance(value, list):
+            size += sum(sys.getsizeof(item) for item in value)
+    return size
+
+
+class MemoryCacheStore(CacheStore):  # pylint: disable=too-many-instance-attributes
+    """Keeps recently used entries in memory in front of another store, with LRU eviction.
+
+    Entries are dropped whenever the backing store's generation changes, so updates
+    made by other processes are still seen."""
+
+    def __init__(self, backing: CacheStore, max_entries: int = 10_000,
+                 max_bytes: int = 64 * 1024 * 1024):
+        self.backing = backing
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.size = 0
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+        self.lock = threading.RLock()
+        self._generation = backing.generation()
+
+    def _check_generation(self):
+        """Clears the entries held in memory if the backing store has changed."""
+        generation = self.backing.generation()
+        if generation != self._generation:
+            self.clear()
+            self._generation = generation
+
+    def _remember(self, key: str, entry: dict | None):
+        """Stores an entry in memory, evicting the least recently used ones over budget."""
+        self.size -= self.sizes.pop(key, 0)
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        self.sizes[key] = _entry_size(key, entry)
+        self.size += self.sizes[key]
+        while self.entries and (len(self.entries) > self.max_entries
+                                or self.size > self.max_bytes):
+            evicted, _ = self.entries.popitem(last=False)
+            self.size -= self.sizes.pop(evicted)
+            self.counters["evictions"] += 1
+
+    def get(self, key: str) -> dict | None:
+        """Returns an entry from memory, falling back to the backing store."""
+        with self.lock:
+            self._check_generation()
+            if key in self.entries:
+                self.counters["hits"] += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.counters["misses"] += 1
+            entry = self.backing.get(key)
+            self._remember(key, entry)
+            return entry
+
+    def update_many(self, entries: dict):
+        """Writes entries through to the backing store and keeps them in memory."""
+        with self.lock:
+            self._check_generation()
+            self.backing.update_many(entries)
+            self._generation = self.backing.generation()
+            for key, fields in entries.items():
+                if key in self.entries:
+                    self._remember(key, {**(self.entries[key] or {}), **fields})
+
+    def delete_many(self, keys):
+        """Removes entries from the backing store and from memory."""
+        keys = list(keys)
+        with self.lock:
+            self._check_generation()
+            self.backing.delete_many(keys)
+            self._generation = self.backing.generation()
+            for key in keys:
+                if key in self.entries:
+                    del self.entries[key]
+                    self.size -= self.sizes.pop(key)
+
+    def load(self) -> dict:
+        """Returns every entry in the backing store as a dictionary."""
+        return self.backing.load()
+
+    def save(self, cache: dict):
+        """Replaces the contents of the backing store and forgets the entries in memory."""
+        with self.lock:
+            self.backing.save(cache)
+            self.clear()
+            self._generation = self.backing.generation()
+
+    def generation(self):
+        """Returns the backing store's generation."""
+        return self.backing.generation()
+
+    def flush(self):
+        """Persists any writes the backing store has buffered."""
+        self.backing.flush()
+
+    def clear(self):
+        """Forgets every entry held in memory."""
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        """Returns the hit, miss and eviction counters and the current memory use."""
+        return {**self.counters, "entries": len(self.entries), "bytes": self.size}
+
+
+class WriteBehindCacheStore(CacheStore):  # pylint: disable=too-many-instance-attributes
+    """Buffers writes in memory and persists them to another store from a background thread.
+
+    Buffered entries are flushed in one update_many call once max_batch keys are waiting
+    or interval seconds have passed, whichever comes first, and again when the
+    interpreter exits."""
+
+    def __init__(self, backing: CacheStore, max_batch: int = 100, interval: float = 0.5):
+        self.backing = backing
+        self.max_batch = max_batch
+        self.interval = interval
+        self.pending = {}
+        self.flushing = {}
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.metrics = {"flushes": 0, "entries_flushed": 0, "last_flush_seconds": 0.0,
+                        "max_flush_seconds": 0.0, "total_flush_seconds": 0.0,
+                        "max_queue_depth": 0, "flush_errors": 0}
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        """Flushes buffered writes whenever a batch fills up or the interval passes.
+
+        A failed flush is logged and retried after the next interval."""
+        failed = False
+        while True:
+            with self.condition:
+                if not self.closed and (failed or len(self.pending) < self.max_batch):
+                    self.condition.wait(self.interval)
+                if self.closed:
+                    return
+            try:
+                self.flush()
+                failed = False
+            except Exception:  # pylint: disable=broad-exception-caught
+                failed = True
+                self.metrics["flush_errors"] += 1
+                import logging  # pylint: disable=import-outside-toplevel
+                logging.getLogger("postcode.cache").exception(
+                    "Couldn't flush buffered cache writes; retrying.")
+
+    def get(self, key: str) -> dict | None:
+        """Returns an entry, including any of its fields that haven't been flushed yet.
+
+        Fields in a flush that hasn't finished are included too, so they never briefly
+        disappear."""
+        with self.condition:
+            flushing = self.flushing.get(key)
+            pending = self.pending.get(key)
+        entry = self.backing.get(key)
+        if pending is None and flushing is None:
+            return entry
+        return {**(entry or {}), **(flushing or {}), **(pending or {})}
+
+    def update_many(self, entries: dict):
+        """Buffers fields to be merged into the backing store by the next flush."""
+        with self.condition:
+            for key, fields in entries.items():
+                self.pending.setdefault(key, {}).update(fields)
+            depth = len(self.pending)
+            self.metrics["max_queue_depth"] = max(self.metrics["max_queue_depth"], depth)
+            if depth >= self.max_batch:
+                self.condition.notify()
+
+    def delete_many(self, keys):
+        """Removes entries from the buffer and from the backing store."""
+        keys = list(keys)
+        with self.flush_lock:
+            with self.condition:
+                for key in keys:
+                    self.pending.pop(key, None)
+            self.backing.delete_many(keys)
+
+    def flush(self):
+        """Writes every buffered entry to the backing store in one batch."""
+        with self.flush_lock:
+            with self.condition:
+                batch, self.pending = self.pending, {}
+                self.flushing = batch
+            if not batch:
+                return
+            started = time.perf_counter()
+            try:
+                self.backing.update_many(batch)
+            except BaseException:
+                with self.condition:
+                    for key, fields in batch.items():
+                        self.pending[key] = {**fields, **self.pending.get(key, {})}
+                    self.flushing = {}
+                raise
+            with self.condition:
+                self.flushing = {}
+            elapsed = time.perf_counter() - started
+            self.metrics["flushes"] += 1
+            self.metrics["entries_flushed"] += len(batch)
+            self.metrics["last_flush_seconds"] = elapsed
+            self.metrics["total_flush_seconds"] += elapsed
+            self.metrics["max_flush_seconds"] = max(self.metrics["max_flush_seconds"], elapsed)
+            self.backing.flush()
+
+    def load(self) -> dict:
+        """Flushes buffered writes, then returns every entry in the backing store."""
+        self.flush()
+        return self.backing.load()
+
+    def save(self, cache: dict):
+        """Discards buffered writes and replaces the contents of the backing store."""
+        with self.flush_lock:
+            with self.condition:
+                self.pending = {}
+            self.backing.save(cache)
+
+    def generation(self):
+        """Returns the backing store's generation."""
+        return self.backing.generation()
+
+    def close(self):
+        """Flushes buffered writes and stops the background thread."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        self.flush()
+        atexit.unregister(self.close)
+
+    def stats(self) -> dict:
+        """Returns flush counts and latencies and the current and maximum queue depth."""
+        with self.condition:
+            return {**self.metrics, "queue_depth": len(self.pending)}
+
+
+class LocationCache:
+    """Caches reverse lookups under coordinates rounded to a number of decimal places.
+
+    Entries live in a CacheStore under "@lat,long" keys, expire after ttl seconds and are
+    evicted least recently used first once the store holds more than max_entries. The
+    first write purges expired entries left by earlier runs and counts the rest, oldest
+    first, towards the limit. With keep_results, the API's whole nearest-N list is stored, and a
+    query in the same or a neighbouring cell is answered from it whenever the list is
+    guaranteed to contain that query's nearest postcode."""
+
+    def __init__(self, store: CacheStore, *, precision: int = 4, ttl: float = 86_400,
+                 max_entries: int = 10_000, keep_results: bool = False):
+        self.store = store
+        self.precision = precision
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.keep_results = keep_results
+        self.keys = None
+        self.lock = threading.Lock()
+
+    def _seed(self) -> list[str]:
+        """Loads the location keys already in the store, returning the expired ones."""
+        now = time.time()
+        entries = sorted((entry.get("fetched_at", 0), key)
+                         for key, entry in self.store.load().items() if key.startswith("@"))
+        self.keys = OrderedDict((key, True) for fetched_at, key in entries
+                                if now - fetched_at <= self.ttl)
+        return [key for fetched_at, key in entries if now - fetched_at > self.ttl]
+
+    def _cell(self, lat: float, long: float) -> tuple[int, int]:
+        """Returns the grid cell containing a point."""
+        scale = 10 ** self.precision
+        return round(lat * scale), round(long * scale)
+
+    def _key(self, cell: tuple[int, int]) -> str:
+        """Returns the cache key for a grid cell."""
+        scale = 10 ** self.precision
+        return f"@{cell[0] / scale:.{self.precision}f},{cell[1] / scale:.{self.precision}f}"
+
+    def _fresh(self, key: str) -> dict | None:
+        """Returns the unexpired entry stored under a key."""
+        entry = self.store.get(key)
+        if not entry or time.time() - entry.get("fetched_at", 0) > self.ttl:
+            return None
+        with self.lock:
+            if self.keys is not None and key in self.keys:
+                self.keys.move_to_end(key)
+        return entry
+
+    def get(self, lat: float, long: float) -> str | None:
+        """Returns the cached nearest postcode for a location, or None."""
+        cell = self._cell(lat, long)
+        postcode = None
+        if not self.keep_results:
+            entry = self._fresh(self._key(cell))
+            postcode = entry.get("nearest") if entry else None
+        else:
+            neighbours = ((cell[0] + d_lat, cell[1] + d_long)
+                          for d_lat in (0, -1, 1) for d_long in (0, -1, 1))
+            for neighbour in neighbours:
+                entry = self._fresh(self._key(neighbour))
+                postcode = _nearest_from_results(entry, lat, long) if entry else None
+                if postcode:
+                    break
+        metrics.count("cache_hits" if postcode else "cache_misses", field="location")
+        return postcode
+
+    def put(self, lat: float, long: float, results: list[dict], radius: float = 100,
+            limit: int = 10):
+        """Stores the API's results for a location."""
+        self.put_many([(lat, long, results)], radius, limit)
+
+    def put_many(self, lookups, radius: float = 100, limit: int = 10):
+        """Stores the API's results for several (lat, long, results) lookups in one write."""
+        entries = {}
+        for lat, long, results in lookups:
+            entry = {"nearest": results[0]["postcode"], "fetched_at": time.time()}
+            if self.keep_results:
+                full = len(results) >= limit
+                entry.update({
+                    "lat": lat, "long": long,
+                    "coverage": results[-1].get("distance", 0) if full else radius,
+                    "results": [{"postcode": item["postcode"], "latitude": item["latitude"],
+                                 "longitude": item["longitude"]} for item in results]})
+            entries[self._key(self._cell(lat, long))] = entry
+        if not entries:
+            return
+        self.store.update_many(entries)
+        with self.lock:
+            evicted = self._seed() if self.keys is None else []
+            for key in entries:
+                self.keys[key] = True
+                self.keys.move_to_end(key)
+            while len(self.keys) > self.max_entries:
+                evicted.append(self.keys.popitem(last=False)[0])
+        if evicted:
+            self.store.delete_many(evicted)
+
+
+def _nearest_from_results(entry: dict, lat: float, long: float) -> str | None:
+    """Returns the nearest stored postcode if the stored list must contain it."""
+    if "results" not in entry:
+        return None
+    offset = distance(lat, long, entry["lat"], entry["long"])
+    best = min(entry["results"], default=None,
+               key=lambda item: distance(lat, long, item["latitude"], item["longitude"]))
+    if best is None:
+        return None
+    if distance(lat, long, best["latitude"], best["longitude"]) + offset > entry["coverage"]:
+        return None
+    return best["postcode"]
+
+
+def main():
+    """Runs the cache maintenance commands."""
+    from argparse import ArgumentParser  # pylint: disable=import-outside-toplevel
+    parser = ArgumentParser(description="Maintain postcode cache files.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    convert = commands.add_parser("convert", help="Convert a cache file to another format.")
+    convert.add_argument("source", help="The cache file to read, in any format.")
+    convert.add_argument("destination", help="Where to write it; may be the source.")
+    convert.add_argument("--format", "-f", choices=list(STORE_FORMATS), default="compact",
+                         help="The format to write.")
+    compact = commands.add_parser(
+        "compact", help="Merge entries stored under different spellings of a postcode.")
+    compact.add_argument("path", help="The cache file to compact, in any format.")
+    args = parser.parse_args()
+    if args.command == "compact":
+        before, after = compact_cache(args.path)
+        print(f"Merged {before} entries into {after} in {args.path}.")
+        return
+    count = convert_cache(args.source, args.destination, args.format)
+    print(f"Wrote {count} entries to {args.destination} as {args.format}.")
+
+
+if __name__ == "__main__":
+    main()
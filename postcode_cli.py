@@ -1,24 +1,169 @@
-"""A CLI application for interacting with the Postcode API."""
+"""A CLI application for interacting with the Postcode API.
 
+Lookups are sent to postcode_daemon when one is running, and otherwise run in this
+process; postcode_functions is only imported in the second case."""
+
+import csv
+import json
+import sys
 from argparse import ArgumentParser
-from postcode_functions import validate_postcode, get_postcode_completions
+from contextlib import contextmanager
+from itertools import islice
+import postcode_metrics as metrics
+from postcode_daemon import DaemonUnavailable, connect
 
-if __name__ == "__main__":
-    parser = ArgumentParser()
-    parser.add_argument("--mode", "-m", required=True, choices=["validate", "complete"],
-                        help="Choose a mode: 'validate' or 'complete'.")
-    parser.add_argument("postcode", type=str, help="The postcode string.")
-    args = parser.parse_args()
+BATCH_SIZE = 100
+BATCH_WORKERS = 4
+
+_daemon = None  # pylint: disable=invalid-name
+
+
+def lookup(function: str, *args):
+    """Runs one of the postcode_functions lookups, in the daemon if one is running.
+
+    If the daemon can't be reached, this and every later lookup run locally instead."""
+    global _daemon  # pylint: disable=global-statement
+    if _daemon is not None:
+        try:
+            return _daemon.call(function, *args)
+        except DaemonUnavailable:
+            _daemon = None
+    import postcode_functions  # pylint: disable=import-outside-toplevel
+    return getattr(postcode_functions, function)(*args)
+
+
+def read_postcodes(lines):
+    """Yields each non-blank line as an uppercase postcode with no surrounding spaces."""
+    for line in lines:
+        postcode = line.strip().upper()
+        if postcode:
+            yield postcode
+
+
+def process_batch(mode: str, batch: list[str]) -> list[tuple[str, object]]:
+    """Returns (postcode, result) pairs for a batch of postcodes."""
+    if mode == "validate":
+        results = lookup("validate_postcodes", batch)
+        return [(postcode, results[postcode]) for postcode in batch]
+    from concurrent.futures import ThreadPoolExecutor  # pylint: disable=import-outside-toplevel
+    with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as executor:
+        return list(zip(batch, executor.map(
+            lambda postcode: lookup("get_postcode_completions", postcode), batch)))
+
+
+def write_results(mode: str, results: list[tuple[str, object]], output_format: str, writer):
+    """Writes a batch of results as CSV rows or JSON Lines."""
+    field = "valid" if mode == "validate" else "completions"
+    for postcode, result in results:
+        if output_format == "jsonl":
+            sys.stdout.write(json.dumps({"postcode": postcode, field: result}) + "\n")
+        elif mode == "validate":
+            writer.writerow([postcode, "true" if result else "false"])
+        else:
+            writer.writerow([postcode, "|".join(result or [])])
+
+
+def run_batch(mode: str, lines, output_format: str):
+    """Streams postcodes through the bulk functions, writing results as each batch finishes.
+
+    The next batch is read while the previous one is being looked up, so no more than two
+    batches are held in memory at once."""
+    writer = csv.writer(sys.stdout, lineterminator="\n")
+    if output_format == "csv":
+        writer.writerow(["postcode", "valid" if mode == "validate" else "completions"])
+    postcodes = read_postcodes(lines)
+    from concurrent.futures import ThreadPoolExecutor  # pylint: disable=import-outside-toplevel
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = None
+        while True:
+            batch = list(islice(postcodes, BATCH_SIZE))
+            if pending is not None:
+                write_results(mode, pending.result(), output_format, writer)
+                sys.stdout.flush()
+            if not batch:
+                break
+            pending = executor.submit(process_batch, mode, batch)
+
+
+@contextmanager
+def open_input(name: str):
+    """Opens the file named on the command line, or yields stdin for '-'."""
+    if name == "-":
+        yield sys.stdin
+    else:
+        with open(name, "r", encoding="utf-8") as f:
+            yield f
+
+
+def report_progress(area: str, done: int, total: int):
+    """Prints how far a warm-up has got through an area to stderr."""
+    print(f"{area}: {done}/{total} postcodes", file=sys.stderr, flush=True)
+
+
+def run_warm(areas: list[str]):
+    """Caches every postcode in some outward codes or areas, in this process."""
+    import postcode_warm  # pylint: disable=import-outside-toplevel
+    for area, count in postcode_warm.warm_cache(areas, report_progress).items():
+        print(f"Cached {count} postcodes in {area}.")
+
+
+def run(args):
+    """Runs the mode chosen on the command line."""
+    if args.mode == "warm" and not args.batch:
+        run_warm(args.postcode.replace(",", " ").split())
+        return
+    if args.batch:
+        with open_input(args.postcode) as lines:
+            if args.mode == "warm":
+                run_warm(list(read_postcodes(lines)))
+            else:
+                run_batch(args.mode, lines, args.format)
+        return
     postcode = args.postcode.strip().upper()
     if args.mode == "validate":
-        if validate_postcode(postcode):
+        if lookup("validate_postcode", postcode):
             print(f"{postcode} is a valid postcode.")
         else:
             print(f"{postcode} is not a valid postcode.")
     if args.mode == "complete":
-        results = get_postcode_completions(postcode)
+        results = lookup("get_postcode_completions", postcode)
         if results:
             for result in results[:5]:
                 print(result.upper())
         else:
             print(f"No matches for {postcode}.")
+
+
+def main():
+    """Parses the command line and prints the results."""
+    parser = ArgumentParser()
+    parser.add_argument("--mode", "-m", required=True, choices=["validate", "complete", "warm"],
+                        help="Choose a mode: 'validate', 'complete' or 'warm', which caches "
+                             "every postcode in the outward codes or areas given.")
+    parser.add_argument("--batch", "-b", action="store_true",
+                        help="Read postcodes, one per line, from the file named by the "
+                             "postcode argument ('-' for stdin).")
+    parser.add_argument("--format", "-f", choices=["csv", "jsonl"], default="csv",
+                        help="Output format for batch mode.")
+    parser.add_argument("--stats", action="store_true",
+                        help="Print cache, file and HTTP timings and counters to stderr. "
+                             "Lookups run in this process.")
+    parser.add_argument("--no-daemon", action="store_true",
+                        help="Run lookups in this process even if a daemon is running.")
+    parser.add_argument("postcode", type=str,
+                        help="The postcode string, or outward codes and areas to warm.")
+    args = parser.parse_args()
+    if args.stats:
+        metrics.set_sink(metrics.MemorySink())
+    elif not args.no_daemon:
+        global _daemon  # pylint: disable=global-statement
+        _daemon = connect()
+    try:
+        run(args)
+    finally:
+        if args.stats:
+            print(metrics.get_sink().summary(), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
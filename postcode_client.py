@@ -0,0 +1,193 @@
+"""A pooled HTTP client for the Postcode API."""
+
+import os
+import random
+import threading
+import time
+import requests as req
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import postcode_metrics as metrics
+
+API_URL = os.environ.get("POSTCODE_API_URL", "https://api.postcodes.io")
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+class TokenBucket:
+    """Limits requests to rate per second, with bursts of up to burst requests.
+
+    The bucket holds at least one token, so rates below one per second still let a
+    request through every 1/rate seconds. A rate of None never limits, but the bucket
+    can still be paused, for example for a Retry-After period."""
+
+    def __init__(self, rate: float | None = None, burst: float | None = None):
+        if rate is not None and rate <= 0:
+            raise ValueError("The rate must be positive.")
+        if burst is not None and burst <= 0:
+            raise ValueError("The burst must be positive.")
+        self.rate = rate
+        self.capacity = max(1, burst or rate or 0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request may be sent."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.rate is None:
+                        return
+                    self.tokens = min(self.capacity,
+                                      self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Stops any request from being sent for a number of seconds."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def state(self) -> dict:
+        """Returns the rate, the tokens available and how long the bucket is paused for."""
+        with self.lock:
+            return {"rate": self.rate, "tokens": self.tokens,
+                    "paused_for": max(0.0, self.paused_until - time.monotonic())}
+
+
+class AdaptiveLimit:  # pylint: disable=too-many-instance-attributes
+    """Caps the number of requests in flight, adjusting the cap by AIMD.
+
+    Each quick, successful response raises the limit by 1/limit, so by about one per
+    round of requests. A throttled or slower-than-target response halves it, at most
+    once per round trip."""
+
+    def __init__(self, initial: float = 8, minimum: float = 1, maximum: float = 64,
+                 target_latency: float = 2.0):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.counters = {"requests": 0, "throttled": 0, "slow": 0, "decreases": 0}
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Blocks until fewer requests than the limit are in flight."""
+        with self.condition:
+            while self.in_flight >= max(1, int(self.limit)):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency: float, throttled: bool = False):
+        """Records a finished request and adjusts the limit."""
+        with self.condition:
+            self.in_flight -= 1
+            self.counters["requests"] += 1
+            slow = latency > self.target_latency
+            self.counters["throttled"] += throttled
+            self.counters["slow"] += slow
+            now = time.monotonic()
+            if throttled or slow:
+                if now - self.last_decrease >= latency:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self.last_decrease = now
+                    self.counters["decreases"] += 1
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def state(self) -> dict:
+        """Returns the limit, the requests in flight and the feedback counters."""
+        with self.condition:
+            return {"limit": self.limit, "in_flight": self.in_flight, **self.counters}
+
+
+def retry_delay(response: req.Response, attempt: int, backoff_factor: float,
+                backoff_jitter: float) -> float:
+    """Returns how long to wait before retrying a throttled response.
+
+    The Retry-After header is used when it gives a number of seconds, otherwise the
+    delay backs off exponentially with jitter."""
+    try:
+        return max(0.0, float(response.headers["Retry-After"]))
+    except (KeyError, ValueError):
+        return backoff_factor * 2 ** attempt + random.uniform(0, backoff_jitter)
+
+
+class PostcodeClient:  # pylint: disable=too-many-instance-attributes
+    """Sends requests through one keep-alive Session, retrying throttled and failed calls.
+
+    Requests wait for a token bucket and an adaptive concurrency limit. A 429 response
+    pauses the bucket, so every thread sharing the client backs off together, and the
+    request is retried. 5xx responses are retried by urllib3. Once retries are used up
+    the last response is returned, so callers still see its status code."""
+
+    def __init__(self, base_url: str = API_URL, *,  # pylint: disable=too-many-arguments
+                 pool_size: int = 20, retries: int = 3, backoff_factor: float = 0.2,
+                 backoff_jitter: float = 0.1, timeout: float | tuple = 10,
+                 rate_limiter: TokenBucket | None = None,
+                 concurrency: AdaptiveLimit | None = None):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = (backoff_factor, backoff_jitter)
+        self.rate_limiter = rate_limiter or TokenBucket()
+        self.concurrency = concurrency or AdaptiveLimit(maximum=pool_size)
+        self.session = req.Session()
+        retry = Retry(total=retries, status_forcelist=RETRY_STATUSES, allowed_methods=None,
+                      backoff_factor=backoff_factor, backoff_jitter=backoff_jitter,
+                      raise_on_status=False, respect_retry_after_header=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method: str, path: str, **kwargs) -> req.Response:
+        """Sends a request for a path on the API within the rate and concurrency limits."""
+        kwargs.setdefault("timeout", self.timeout)
+        for attempt in range(self.retries + 1):
+            self.rate_limiter.acquire()
+            self.concurrency.acquire()
+            started = time.monotonic()
+            throttled = False
+            try:
+                response = self.session.request(method, f"{self.base_url}{path}", **kwargs)
+                throttled = response.status_code == 429
+            except req.RequestException:
+                metrics.count("http_errors", method=method)
+                raise
+            finally:
+                elapsed = time.monotonic() - started
+                self.concurrency.release(elapsed, throttled)
+            metrics.count("http_responses", method=method, status=response.status_code)
+            metrics.observe("http_request", elapsed, method=method, status=response.status_code)
+            if not throttled or attempt == self.retries:
+                break
+            self.rate_limiter.pause(retry_delay(response, attempt, *self.backoff))
+        return response
+
+    def get(self, path: str, **kwargs) -> req.Response:
+        """Sends a GET request for a path on the API."""
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> req.Response:
+        """Sends a POST request for a path on the API."""
+        return self.request("POST", path, **kwargs)
+
+    def state(self) -> dict:
+        """Returns the state of the rate limiter and the concurrency limit."""
+        return {"rate_limiter": self.rate_limiter.state(),
+                "concurrency": self.concurrency.state()}
+
+    def close(self):
+        """Closes every pooled connection."""
+        self.session.close()
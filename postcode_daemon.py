@@ -0,0 +1,140 @@
+"""A long-lived local server that answers postcode lookups over a Unix socket.
+
+The daemon keeps the cache warm in memory and the HTTP connections pooled, so short-lived
+clients such as postcode_cli only pay for a socket round trip. Requests and responses
+are single lines of JSON."""
+
+import json
+import os
+import socket
+import stat
+
+SOCKET_PATH = os.environ.get(
+    "POSTCODE_DAEMON_SOCKET",
+    os.path.join(os.environ.get("XDG_RUNTIME_DIR", "/tmp"), f"postcode-{os.getuid()}.sock"))
+FUNCTIONS = ("validate_postcode", "validate_postcodes", "get_postcode_completions",
+             "get_postcode_for_location", "get_postcodes_details")
+ERRORS = {"TypeError": TypeError, "ValueError": ValueError}
+
+
+class DaemonUnavailable(OSError):
+    """Raised when no daemon is listening on the socket."""
+
+
+class DaemonClient:  # pylint: disable=too-few-public-methods
+    """Calls the lookup functions in a running daemon, one connection per call."""
+
+    def __init__(self, socket_path: str = SOCKET_PATH, timeout: float = 30):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def call(self, function: str, *args):
+        """Runs a function in the daemon and returns its result or raises its error.
+
+        Raises DaemonUnavailable if the daemon can't be reached. Once connected, a timeout
+        is raised as a RequestException instead, since the daemon may still be calling the
+        API and the lookup shouldn't be repeated locally."""
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(self.timeout)
+            try:
+                connection.connect(self.socket_path)
+            except OSError as error:
+                raise DaemonUnavailable(str(error)) from error
+            try:
+                connection.sendall(json.dumps({"function": function, "args": args}).encode()
+                                   + b"\n")
+                with connection.makefile("rb") as reader:
+                    line = reader.readline()
+            except TimeoutError as error:
+                import requests as req  # pylint: disable=import-outside-toplevel
+                raise req.RequestException("The daemon didn't answer in time.") from error
+            except OSError as error:
+                raise DaemonUnavailable(str(error)) from error
+        if not line:
+            raise DaemonUnavailable("The daemon closed the connection.")
+        return _result(json.loads(line))
+
+
+def _result(response: dict):
+    """Returns the result of a daemon response, or raises the error it reports."""
+    if "error" not in response:
+        return response["result"]
+    if response["error"] in ERRORS:
+        raise ERRORS[response["error"]](response["message"])
+    import requests as req  # pylint: disable=import-outside-toplevel
+    raise req.RequestException(response["message"])
+
+
+def connect(socket_path: str = SOCKET_PATH) -> DaemonClient | None:
+    """Returns a client for the daemon if its socket exists and is ours, otherwise None.
+
+    Sockets owned by other users are ignored, since anyone can create one in a shared
+    directory such as /tmp."""
+    try:
+        status = os.stat(socket_path)
+    except OSError:
+        return None
+    if not stat.S_ISSOCK(status.st_mode) or status.st_uid != os.getuid():
+        return None
+    return DaemonClient(socket_path)
+
+
+def answer(request: dict) -> dict:
+    """Runs one request against postcode_functions, returning the response to send."""
+    import postcode_functions  # pylint: disable=import-outside-toplevel
+    import requests as req  # pylint: disable=import-outside-toplevel
+    if request.get("function") not in FUNCTIONS:
+        return {"error": "ValueError", "message": "Unknown function."}
+    try:
+        return {"result": getattr(postcode_functions, request["function"])(*request["args"])}
+    except (TypeError, ValueError, req.RequestException) as error:
+        name = type(error).__name__ if type(error) in ERRORS.values() else "RequestException"
+        return {"error": name, "message": str(error)}
+
+
+def serve(socket_path: str = SOCKET_PATH):
+    """Answers requests on a Unix socket until interrupted, then flushes the cache."""
+    import socketserver  # pylint: disable=import-outside-toplevel
+    import postcode_functions  # pylint: disable=import-outside-toplevel
+
+    class Handler(socketserver.StreamRequestHandler):
+        """Answers each line of JSON with a line of JSON."""
+
+        def handle(self):
+            for line in self.rfile:
+                response = answer(json.loads(line))
+                self.wfile.write(json.dumps(response).encode() + b"\n")
+
+    if os.path.exists(socket_path):
+        try:
+            DaemonClient(socket_path, timeout=1).call("validate_postcodes", [])
+            raise SystemExit(f"A daemon is already listening on {socket_path}.")
+        except DaemonUnavailable:
+            os.unlink(socket_path)
+    server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+    os.chmod(socket_path, 0o600)
+    server.daemon_threads = True
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        postcode_functions.flush_cache()
+
+
+def main():
+    """Starts the daemon."""
+    import signal  # pylint: disable=import-outside-toplevel
+    from argparse import ArgumentParser  # pylint: disable=import-outside-toplevel
+    parser = ArgumentParser(description="Serve postcode lookups on a Unix socket.")
+    parser.add_argument("--socket", "-s", default=SOCKET_PATH, help="The socket to listen on.")
+    args = parser.parse_args()
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    serve(args.socket)
+
+
+if __name__ == "__main__":
+    main()
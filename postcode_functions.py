@@ -1,83 +1,559 @@
-"""Functions that interact with the Postcode API."""
+"""Functions that interact with the Postcode API.
+
+The HTTP stack (requests, urllib3 and postcode_client) is only imported once a lookup
+misses the cache, so answering from the cache stays cheap for short-lived processes."""
 
 import os
-import json
-import requests as req
+import threading
+import time
+from typing import TYPE_CHECKING
+import postcode_metrics as metrics
+from postcode_cache import CacheStore, LocationCache, MemoryCacheStore, open_cache_store
+from postcode_geo import GeoIndex
+from postcode_index import (PLAUSIBLE_POSTCODE, PostcodeIndex, canonical, matches_format,
+                            normalise)
+
+if TYPE_CHECKING:
+    import requests as req
+    from postcode_client import PostcodeClient
 
 CACHE_FILE = "./postcode_cache.json"
+INDEX_FILE = "./postcode_index.bin"
+BULK_LIMIT = 100
+BULK_WORKERS = 4
+COMPLETION_LIMIT = 10
+# Seconds each cached field stays fresh (None never expires), then how much longer a
+# stale value may still be served while it is refreshed in the background. Postcodes
+# change quarterly, so validity and completions are rechecked after 90 days.
+CACHE_TTLS = {'valid': 90 * 24 * 60 * 60, 'completions': 90 * 24 * 60 * 60,
+              'details': 7 * 24 * 60 * 60}
+STALE_TTLS = {'valid': 24 * 60 * 60, 'completions': 24 * 60 * 60, 'details': 0}
+# Seconds to keep an empty answer (None or no completions), and an API error.
+NEGATIVE_TTLS = {'valid': 60 * 60, 'completions': 60 * 60, 'details': 60 * 60}
+ERROR_TTL = 30
+# Postcodes that don't match this format are rejected without a lookup; set it to
+# postcode_index.UK_POSTCODE to only accept complete UK postcodes.
+POSTCODE_FORMAT = PLAUSIBLE_POSTCODE
 # pylint: disable=inconsistent-return-statements
 
+_cache_store: CacheStore | None = None  # pylint: disable=invalid-name
+_client: "PostcodeClient | None" = None  # pylint: disable=invalid-name
+_offline_index: PostcodeIndex | bool | None = None  # pylint: disable=invalid-name
+_geo_index: GeoIndex | None = None  # pylint: disable=invalid-name
+_location_cache: LocationCache | None = None  # pylint: disable=invalid-name
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+class SingleFlight:
+    """Lets concurrent callers with the same key share one call and its result or exception."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.counters = {"calls": 0, "executed": 0, "coalesced": 0}
+
+    def do(self, key, function):
+        """Returns function(), or the result of the identical call already in flight."""
+        with self.lock:
+            self.counters["calls"] += 1
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = {"done": threading.Event(), "result": None, "error": None}
+                self.flights[key] = flight
+                self.counters["executed"] += 1
+            else:
+                self.counters["coalesced"] += 1
+        if not leader:
+            flight["done"].wait()
+            if flight["error"] is not None:
+                raise flight["error"]
+            return flight["result"]
+        try:
+            flight["result"] = function()
+            return flight["result"]
+        except BaseException as error:
+            flight["error"] = error
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight["done"].set()
+
+    def stats(self) -> dict:
+        """Returns how many calls were made, executed and coalesced."""
+        with self.lock:
+            return dict(self.counters)
+
+
+SINGLE_FLIGHT = SingleFlight()
+
+
+def get_cache_store() -> CacheStore:
+    """Returns the active cache store, defaulting to CACHE_FILE behind an in-memory LRU.
+
+    The file may be JSON, compact or SQLite; its format is detected when it's opened."""
+    global _cache_store  # pylint: disable=global-statement
+    if _cache_store is None:
+        _cache_store = MemoryCacheStore(open_cache_store(CACHE_FILE))
+    return _cache_store
+
+
+def set_cache_store(store: CacheStore | None):
+    """Replaces the cache store used by every function; None restores the default.
+
+    The location cache is reset to the default one on the new store."""
+    global _cache_store, _location_cache  # pylint: disable=global-statement
+    _cache_store = store
+    _location_cache = None
+
+
+def flush_cache():
+    """Persists any cache writes that the active store has buffered."""
+    get_cache_store().flush()
+
+
+def get_location_cache() -> LocationCache:
+    """Returns the cache for reverse lookups, defaulting to one on the active cache store."""
+    global _location_cache  # pylint: disable=global-statement
+    if _location_cache is None:
+        _location_cache = LocationCache(get_cache_store())
+    return _location_cache
+
+
+def set_location_cache(cache: LocationCache | None):
+    """Replaces the cache for reverse lookups; None restores the default."""
+    global _location_cache  # pylint: disable=global-statement
+    _location_cache = cache
+
+
+def get_client() -> "PostcodeClient":
+    """Returns the HTTP client shared by every function, importing it on first use."""
+    global _client  # pylint: disable=global-statement
+    if _client is None:
+        from postcode_client import PostcodeClient  # pylint: disable=import-outside-toplevel
+        _client = PostcodeClient()
+    return _client
+
+
+def set_client(client: "PostcodeClient | None"):
+    """Replaces the HTTP client used by every function; None restores the default."""
+    global _client  # pylint: disable=global-statement
+    _client = client
+
+
+def get_offline_index() -> PostcodeIndex | None:
+    """Returns the offline postcode index, mapping INDEX_FILE the first time if it exists."""
+    global _offline_index  # pylint: disable=global-statement
+    if _offline_index is None:
+        _offline_index = PostcodeIndex(INDEX_FILE) if os.path.exists(INDEX_FILE) else False
+    return _offline_index or None
+
+
+def set_offline_index(index: PostcodeIndex | None):
+    """Replaces the offline postcode index; None looks for INDEX_FILE again."""
+    global _offline_index  # pylint: disable=global-statement
+    _offline_index = index
+
+
+def get_geo_index() -> GeoIndex | None:
+    """Returns the offline index of postcode centroids, if one has been set."""
+    return _geo_index
+
+
+def set_geo_index(index: GeoIndex | None):
+    """Replaces the offline index of postcode centroids used for location lookups."""
+    global _geo_index  # pylint: disable=global-statement
+    _geo_index = index
+
+
 def load_cache() -> dict:
     """Loads the cache from a file and converts it from JSON to a dictionary."""
-    if os.path.exists(CACHE_FILE):
-        with open(CACHE_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    else:
-        return {}
+    with metrics.timed('load_cache'):
+        return get_cache_store().load()
 
 
 def save_cache(cache: dict):
     """Saves the cache to a file as JSON"""
-    with open(CACHE_FILE, "w", encoding="utf-8") as f:
-        return json.dump(cache, f)
+    with metrics.timed('save_cache'):
+        get_cache_store().save(cache)
 
 
-def validate_postcode(postcode: str) -> bool:
-    """Returns a boolean as a check for valid postcodes."""
-    if not isinstance(postcode, str):
-        raise TypeError("Function expects a string.")
-    cache = load_cache()
-    if postcode in cache and 'valid' in cache[postcode]:
-        return cache[postcode]['valid']
-    response = req.get(f"https://api.postcodes.io/postcodes/{postcode}/validate", timeout=10)
-    if response.status_code == 500:
+def check_response(response: "req.Response"):
+    """Raises a RequestException if the API failed or is still throttling requests."""
+    import requests as req  # pylint: disable=import-outside-toplevel,redefined-outer-name
+    if response.status_code >= 500:
         raise req.RequestException("Unable to access API.")
+    if response.status_code == 429:
+        raise req.RequestException("API rate limit exceeded.")
+
+
+def fetch_validation(postcode: str) -> bool | None:
+    """Asks the API whether a postcode is valid, bypassing the cache."""
+    response = get_client().get(f"/postcodes/{postcode}/validate")
+    check_response(response)
     if response.status_code == 200:
-        cache[postcode] = {}
-        cache[postcode]['valid'] = response.json().get('result', False)
-        save_cache(cache)
-        return response.json()['result']
+        return response.json().get('result', False)
 
 
-def get_postcode_for_location(lat: float, long: float) -> str:
-    """Returns a postcode based on longitudinal and latitudinal location."""
-    if not isinstance(lat, float) or not isinstance(long, float):
-        raise TypeError("Function expects two floats.")
-    response = req.get(f"https://api.postcodes.io/postcodes?lon={long}&lat={lat}", timeout=10)
-    if response.status_code == 500:
-        raise req.RequestException("Unable to access API.")
+def fetch_nearest(lat: float, long: float) -> list[dict]:
+    """Asks the API for the postcodes nearest to a location, nearest first."""
+    response = get_client().get(f"/postcodes?lon={long}&lat={lat}")
+    check_response(response)
     if response.json()['result'] is None:
         raise ValueError("No relevant postcode found.")
-    return response.json()['result'][0]['postcode']
+    return response.json()['result']
 
 
-def get_postcode_completions(postcode_start: str) -> list[str]:
-    """Returns a full postcode based on the beginning of a known postcode."""
-    if not isinstance(postcode_start, str):
-        raise TypeError("Function expects a string.")
-    cache = load_cache()
-    if postcode_start in cache and 'completions' in cache[postcode_start]:
-        return cache[postcode_start]['completions']
-    response = req.get(f"https://api.postcodes.io/postcodes/{postcode_start}/autocomplete",
-                        timeout=10)
-    if response.status_code == 500:
-        raise req.RequestException("Unable to access API.")
+def fetch_nearest_many(points: list[tuple[float, float]]) -> list[list[dict] | None]:
+    """Asks the API for the postcodes nearest to each of up to 100 locations in one request."""
+    response = get_client().post("/postcodes", json={'geolocations': [
+        {'latitude': lat, 'longitude': long} for lat, long in points]})
+    check_response(response)
+    return [item['result'] for item in response.json()['result']]
+
+
+def fetch_completions(postcode_start: str) -> list[str] | None:
+    """Asks the API for completions of a partial postcode, bypassing the cache."""
+    response = get_client().get(f"/postcodes/{postcode_start}/autocomplete")
+    check_response(response)
     if response.status_code == 200:
-        cache[postcode_start] = {}
-        cache[postcode_start]['completions'] = response.json().get('result', False)
-        save_cache(cache)
-        return response.json()['result']
+        return response.json().get('result', False)
 
 
-def get_postcodes_details(postcodes: list[str]) -> dict:
-    """Returns the details of given list of postcodes."""
-    if not isinstance(postcodes, list):
+def fetch_details(postcodes: list[str]) -> dict:
+    """Asks the API for the details of a list of postcodes in one request."""
+    response = get_client().post("/postcodes", json={'postcodes': postcodes})
+    check_response(response)
+    return response.json()
+
+
+def check_string(value):
+    """Raises a TypeError unless the value is a string."""
+    if not isinstance(value, str):
+        raise TypeError("Function expects a string.")
+
+
+def check_location(lat, long):
+    """Raises a TypeError unless both coordinates are floats."""
+    if not isinstance(lat, float) or not isinstance(long, float):
+        raise TypeError("Function expects two floats.")
+
+
+def check_string_list(values):
+    """Raises a TypeError unless the value is a list of strings."""
+    if not isinstance(values, list):
         raise TypeError("Function expects a list of strings.")
-    for item in postcodes:
+    for item in values:
         if not isinstance(item, str):
             raise TypeError("Function expects a list of strings.")
-    response = req.post("https://api.postcodes.io/postcodes",
-                        json={'postcodes': postcodes}, timeout=10)
-    if response.status_code == 500:
-        raise req.RequestException("Unable to access API.")
-    return response.json()
+
+
+def freshness(entry: dict | None, field: str) -> str:
+    """Returns whether a cached field is 'fresh', 'stale', 'expired' or 'missing'.
+
+    Empty answers expire after their NEGATIVE_TTLS with no stale period. Entries written
+    before timestamps were recorded count as stale once a TTL is set."""
+    if not entry or field not in entry:
+        return 'missing'
+    negative = entry[field] is None or entry[field] == []
+    ttl = NEGATIVE_TTLS.get(field) if negative else CACHE_TTLS.get(field)
+    if ttl is None:
+        return 'fresh'
+    if f'{field}_at' not in entry:
+        return 'stale'
+    age = time.time() - entry[f'{field}_at']
+    if age <= ttl:
+        return 'fresh'
+    grace = 0 if negative else STALE_TTLS.get(field, 0)
+    return 'stale' if age <= ttl + grace else 'expired'
+
+
+def raise_recent_error(entry: dict | None, field: str):
+    """Raises the API error cached for a field if it happened within ERROR_TTL seconds."""
+    if entry and time.time() - entry.get(f'{field}_error_at', 0) <= ERROR_TTL:
+        import requests as req  # pylint: disable=import-outside-toplevel,redefined-outer-name
+        metrics.count('cached_errors', field=field)
+        raise req.RequestException(entry[f'{field}_error'])
+
+
+def fetch_remembering_errors(field: str, key: str, fetch):
+    """Returns fetch(key), caching any RequestException it raises for ERROR_TTL seconds."""
+    import requests as req  # pylint: disable=import-outside-toplevel,redefined-outer-name
+    try:
+        return fetch(key)
+    except req.RequestException as error:
+        get_cache_store().update(key, {f'{field}_error': str(error),
+                                       f'{field}_error_at': time.time()})
+        raise
+
+
+def cache_lookup(entry: dict | None, field: str) -> str:
+    """Returns the freshness of a cached field, counting the lookup as a hit or a miss."""
+    state = freshness(entry, field)
+    metrics.count('cache_hits' if state in ('fresh', 'stale') else 'cache_misses', field=field)
+    return state
+
+
+def refresh_in_background(field: str, keys: list[str], function):
+    """Runs function on the keys not already being refreshed, in a background thread."""
+    with _refreshing_lock:
+        keys = [key for key in keys if (field, key) not in _refreshing]
+        _refreshing.update((field, key) for key in keys)
+    if not keys:
+        return
+
+    def refresh():
+        import requests as req  # pylint: disable=import-outside-toplevel,redefined-outer-name
+        try:
+            function(keys)
+        except (req.RequestException, ValueError):
+            pass
+        finally:
+            with _refreshing_lock:
+                _refreshing.difference_update((field, key) for key in keys)
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+def refresh_validation(postcode: str) -> bool | None:
+    """Fetches whether a postcode is valid and stores the answer in the cache.
+
+    An unknown answer is cached too, and expires after its negative TTL."""
+    result = fetch_remembering_errors('valid', postcode, fetch_validation)
+    get_cache_store().update(postcode, {'valid': result, 'valid_at': time.time()})
+    return result
+
+
+def refresh_completions(postcode_start: str) -> list[str] | None:
+    """Fetches the completions of a partial postcode and stores them in the cache.
+
+    Having no completions is cached too, and expires after its negative TTL."""
+    result = fetch_remembering_errors('completions', postcode_start, fetch_completions)
+    get_cache_store().update(postcode_start,
+                             {'completions': result, 'completions_at': time.time()})
+    return result
+
+
+def refresh_details(postcodes: list[str]) -> dict:
+    """Fetches the details of postcodes and stores them in the cache."""
+    found = fetch_details_many(postcodes)
+    if found:
+        get_cache_store().update_many({postcode: details_fields(details)
+                                       for postcode, details in found.items()})
+    return found
+
+
+def validate_offline(postcode: str) -> tuple[str, bool | None]:
+    """Returns a postcode's cache key, and its validity if known without the cache or API.
+
+    Postcodes not matching POSTCODE_FORMAT are invalid, and those in the offline index
+    are valid; otherwise the validity is None."""
+    if not matches_format(postcode, POSTCODE_FORMAT):
+        metrics.count('format_rejections')
+        return postcode, False
+    key = canonical(postcode)
+    index = get_offline_index()
+    return key, True if index is not None and key in index else None
+
+
+def validate_postcode(postcode: str) -> bool:
+    """Returns a boolean as a check for valid postcodes."""
+    check_string(postcode)
+    key, known = validate_offline(postcode)
+    if known is not None:
+        return known
+    entry = get_cache_store().get(key)
+    state = cache_lookup(entry, 'valid')
+    if state == 'stale':
+        refresh_in_background('valid', [key], lambda keys: refresh_validation(keys[0]))
+    if state in ('fresh', 'stale'):
+        return entry['valid']
+    raise_recent_error(entry, 'valid')
+    return SINGLE_FLIGHT.do(('valid', key), lambda: refresh_validation(key))
+
+
+def get_postcode_for_location(lat: float, long: float) -> str:
+    """Returns a postcode based on longitudinal and latitudinal location."""
+    check_location(lat, long)
+    postcode = locate_locally(lat, long) or get_location_cache().get(lat, long)
+    if postcode:
+        return postcode
+    results = fetch_nearest(lat, long)
+    get_location_cache().put(lat, long, results)
+    return results[0]['postcode']
+
+
+def locate_locally(lat: float, long: float) -> str | None:
+    """Returns the nearest postcode from the offline centroid index, or None."""
+    index = get_geo_index()
+    if index is not None:
+        nearest = index.nearest(lat, long, limit=1)
+        if nearest:
+            return nearest[0][0]
+
+
+def get_postcode_completions(postcode_start: str) -> list[str]:
+    """Returns a full postcode based on the beginning of a known postcode."""
+    check_string(postcode_start)
+    if not matches_format(postcode_start):
+        metrics.count('format_rejections')
+        return None
+    key = canonical(postcode_start)
+    entry = get_cache_store().get(key)
+    state = cache_lookup(entry, 'completions')
+    if state == 'stale':
+        refresh_in_background('completions', [key], lambda keys: refresh_completions(keys[0]))
+    if state in ('fresh', 'stale'):
+        return entry['completions']
+    raise_recent_error(entry, 'completions')
+    local = complete_locally(key)
+    if local is not False:
+        return local
+    return SINGLE_FLIGHT.do(('completions', key), lambda: refresh_completions(key))
+
+
+def complete_locally(postcode_start: str) -> list[str] | None | bool:
+    """Returns completions known without calling the API, or False if they aren't known.
+
+    The offline index answers any prefix it has postcodes for. Otherwise a cached
+    shorter prefix with fewer completions than the API's cap lists every postcode it
+    covers, so its completions can be filtered for the longer prefix."""
+    index = get_offline_index()
+    if index is not None:
+        completions = index.complete(postcode_start, COMPLETION_LIMIT)
+        if completions:
+            return completions
+    prefix = normalise(postcode_start)
+    store = get_cache_store()
+    for ancestor in dict.fromkeys(postcode_start[:end].strip()
+                                  for end in range(len(postcode_start) - 1, 0, -1)):
+        entry = store.get(ancestor)
+        if freshness(entry, 'completions') not in ('fresh', 'stale'):
+            continue
+        known = entry['completions'] or []
+        if len(known) >= COMPLETION_LIMIT:
+            return False
+        return sorted(postcode for postcode in known
+                      if normalise(postcode).startswith(prefix))[:COMPLETION_LIMIT] or None
+    return False
+
+
+def bulk_executor():
+    """Returns a pool of BULK_WORKERS threads, importing concurrent.futures on first use."""
+    from concurrent.futures import ThreadPoolExecutor  # pylint: disable=import-outside-toplevel
+    return ThreadPoolExecutor(max_workers=BULK_WORKERS)
+
+
+def fetch_details_many(postcodes: list[str]) -> dict:
+    """Looks up any number of postcodes in concurrent chunks, returning {postcode: details}."""
+    chunks = [postcodes[start:start + BULK_LIMIT]
+              for start in range(0, len(postcodes), BULK_LIMIT)]
+    with bulk_executor() as executor:
+        responses = list(executor.map(fetch_details, chunks))
+    return {item['query']: item['result'] for response in responses
+            for item in response['result']}
+
+
+def details_fields(details: dict | None) -> dict:
+    """Returns the cache fields to store for a postcode's bulk lookup result."""
+    now = time.time()
+    return {'valid': details is not None, 'valid_at': now, 'details': details, 'details_at': now}
+
+
+def get_postcodes_details(postcodes: list[str]) -> dict:
+    """Returns the details of given list of postcodes."""
+    check_string_list(postcodes)
+    keys = {postcode: canonical(postcode) for postcode in postcodes}
+    store = get_cache_store()
+    cached = {}
+    stale = []
+    for key in dict.fromkeys(keys.values()):
+        entry = store.get(key)
+        state = cache_lookup(entry, 'details')
+        if state in ('fresh', 'stale'):
+            cached[key] = entry['details']
+        if state == 'stale':
+            stale.append(key)
+    refresh_in_background('details', stale, refresh_details)
+    misses = [key for key in dict.fromkeys(keys.values()) if key not in cached]
+    if not cached and len(misses) <= BULK_LIMIT:
+        response = fetch_details(misses)
+        if not isinstance(response.get('result'), list):
+            return response
+        found = {item['query']: item['result'] for item in response['result']}
+        store.update_many({key: details_fields(details) for key, details in found.items()})
+        return {**response, 'result': [{'query': postcode, 'result': found.get(keys[postcode])}
+                                       for postcode in postcodes]}
+    cached.update(refresh_details(misses))
+    return {'status': 200,
+            'result': [{'query': postcode, 'result': cached.get(keys[postcode])}
+                       for postcode in postcodes]}
+
+
+def validate_postcodes(postcodes) -> dict:
+    """Returns a dictionary of postcode validity, using the bulk lookup for uncached postcodes."""
+    postcodes = list(postcodes)
+    check_string_list(postcodes)
+    store = get_cache_store()
+    results = {}
+    misses = {}
+    stale = []
+    for postcode in postcodes:
+        if postcode in results:
+            continue
+        key, results[postcode] = validate_offline(postcode)
+        if results[postcode] is not None:
+            continue
+        entry = store.get(key)
+        state = cache_lookup(entry, 'valid')
+        if state in ('fresh', 'stale'):
+            results[postcode] = entry['valid'] is True
+        else:
+            misses[postcode] = key
+        if state == 'stale':
+            stale.append(key)
+    refresh_in_background('valid', stale, refresh_details)
+    keys = list(dict.fromkeys(misses.values()))
+    found = fetch_details_many(keys)
+    for postcode, key in misses.items():
+        results[postcode] = found.get(key) is not None
+    if keys:
+        store.update_many({key: details_fields(found.get(key)) for key in keys})
+    return results
+
+
+def get_postcodes_for_locations(points) -> list:
+    """Returns the nearest postcode for each (lat, long) point, in the same order.
+
+    Points that get_postcode_for_location would reject are returned as the TypeError or
+    ValueError it would raise, instead of failing the whole batch."""
+    points = list(points)
+    results = [None] * len(points)
+    misses = []
+    cache = get_location_cache()
+    for position, point in enumerate(points):
+        try:
+            lat, long = point
+            check_location(lat, long)
+        except (TypeError, ValueError):
+            results[position] = TypeError("Function expects two floats.")
+            continue
+        results[position] = locate_locally(lat, long) or cache.get(lat, long)
+        if results[position] is None:
+            misses.append(position)
+    chunks = [misses[start:start + BULK_LIMIT] for start in range(0, len(misses), BULK_LIMIT)]
+    with bulk_executor() as executor:
+        answers = executor.map(lambda chunk: fetch_nearest_many([points[i] for i in chunk]),
+                               chunks)
+        found = []
+        for chunk, nearest in zip(chunks, answers):
+            for position, result in zip(chunk, nearest):
+                if result:
+                    results[position] = result[0]['postcode']
+                    found.append((*points[position], result))
+                else:
+                    results[position] = ValueError("No relevant postcode found.")
+    cache.put_many(found)
+    return results
@@ -0,0 +1,96 @@
+"""A spatial index of postcode centroids for finding postcodes near a location offline."""
+
+import csv
+import math
+from array import array
+
+EARTH_RADIUS = 6_371_000
+METRES_PER_DEGREE = 111_320
+DEFAULT_RADIUS = 100
+MAX_RADIUS = 2000
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 100
+
+
+def distance(lat1: float, long1: float, lat2: float, long2: float) -> float:
+    """Returns the great-circle distance between two points in metres."""
+    lat1, long1, lat2, long2 = map(math.radians, (lat1, long1, lat2, long2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((long2 - long1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+def read_centroids(csv_path: str):
+    """Yields (postcode, lat, long) for the live postcodes in an ONS Postcode Directory CSV.
+
+    Rows with a termination date or without a grid reference are skipped."""
+    with open(csv_path, "r", encoding="utf-8", newline="") as f:
+        for row in csv.DictReader(f):
+            row = {name.strip().lower(): value for name, value in row.items()}
+            if row.get("doterm", "").strip():
+                continue
+            lat, long = float(row["lat"]), float(row["long"])
+            if lat > 90:
+                continue
+            yield row.get("pcds") or row.get("pcd") or row["postcode"], lat, long
+
+
+class GeoIndex:
+    """Buckets postcode centroids into a grid of cells roughly cell_size metres across.
+
+    A query only measures the postcodes in cells that overlap its search radius."""
+
+    def __init__(self, centroids, cell_size: float = 250):
+        self.postcodes = []
+        self.lats = array("d")
+        self.longs = array("d")
+        self.cell_lat = cell_size / METRES_PER_DEGREE
+        self.cell_long = self.cell_lat / math.cos(math.radians(54))
+        self.cells = {}
+        for postcode, lat, long in centroids:
+            self.cells.setdefault(self._cell(lat, long), []).append(len(self.postcodes))
+            self.postcodes.append(postcode)
+            self.lats.append(lat)
+            self.longs.append(long)
+
+    @classmethod
+    def from_csv(cls, csv_path: str, cell_size: float = 250):
+        """Builds an index from an ONS Postcode Directory CSV file."""
+        return cls(read_centroids(csv_path), cell_size)
+
+    def __len__(self) -> int:
+        return len(self.postcodes)
+
+    def _cell(self, lat: float, long: float) -> tuple:
+        """Returns the grid cell containing a point."""
+        return (math.floor(lat / self.cell_lat), math.floor(long / self.cell_long))
+
+    def _cells_within(self, lat: float, long: float, radius: float):
+        """Yields every grid cell that overlaps a radius around a point."""
+        delta_lat = radius / METRES_PER_DEGREE
+        delta_long = delta_lat / max(math.cos(math.radians(lat)), 0.01)
+        low_lat, low_long = self._cell(lat - delta_lat, long - delta_long)
+        high_lat, high_long = self._cell(lat + delta_lat, long + delta_long)
+        for cell_lat in range(low_lat, high_lat + 1):
+            for cell_long in range(low_long, high_long + 1):
+                yield cell_lat, cell_long
+
+    def nearest(self, lat: float, long: float, radius: float = DEFAULT_RADIUS,
+                limit: int = DEFAULT_LIMIT) -> list[tuple[str, float]]:
+        """Returns (postcode, metres) pairs within a radius of a point, nearest first.
+
+        The radius and limit are capped at the same maximums as the API."""
+        radius = min(radius, MAX_RADIUS)
+        found = []
+        for cell in self._cells_within(lat, long, radius):
+            for i in self.cells.get(cell, ()):
+                metres = distance(lat, long, self.lats[i], self.longs[i])
+                if metres <= radius:
+                    found.append((metres, i))
+        found.sort()
+        return [(self.postcodes[i], metres) for metres, i in found[:min(limit, MAX_LIMIT)]]
+
+    def nearest_many(self, points, radius: float = DEFAULT_RADIUS,
+                     limit: int = DEFAULT_LIMIT) -> list[list[tuple[str, float]]]:
+        """Returns the nearest postcodes for each (lat, long) point, in order."""
+        return [self.nearest(lat, long, radius, limit) for lat, long in points]
@@ -0,0 +1,148 @@
+"""A memory-mapped index of known postcodes for answering lookups offline."""
+
+import csv
+import mmap
+import re
+import struct
+from argparse import ArgumentParser
+
+MAGIC = b"PCIDX\x00\x01\x00"
+HEADER = struct.Struct("<8sII")
+WIDTH = 7
+POSTCODE_COLUMNS = ("pcds", "pcd", "pcd2", "postcode")
+# Formats matched against normalised postcodes: anything short enough to be a postcode or
+# a prefix of one, and the full UK format (an outward code, then a digit and two letters).
+PLAUSIBLE_POSTCODE = re.compile(r"[A-Z0-9]{1,7}")
+UK_POSTCODE = re.compile(r"GIR0AA|[A-Z]{1,2}[0-9][A-Z0-9]?[0-9][A-Z]{2}")
+
+
+def normalise(postcode: str) -> str:
+    """Returns a postcode in upper case with all whitespace removed."""
+    return "".join(postcode.split()).upper()
+
+
+def display(postcode: str) -> str:
+    """Returns a normalised postcode with a space between its outward and inward codes."""
+    return f"{postcode[:-3]} {postcode[-3:]}"
+
+
+def canonical(postcode: str) -> str:
+    """Returns the spelling a postcode or prefix is cached under.
+
+    Case and runs of whitespace are normalised, and a complete UK postcode gets exactly
+    one space between its outward and inward codes, so "tn120aa" and " TN12 0AA " share
+    the key "TN12 0AA". Prefixes keep their own spacing, since it can't be inferred."""
+    compact = normalise(postcode)
+    if UK_POSTCODE.fullmatch(compact):
+        return display(compact)
+    return " ".join(postcode.split()).upper()
+
+
+def matches_format(postcode: str, pattern: re.Pattern = PLAUSIBLE_POSTCODE) -> bool:
+    """Returns whether a postcode matches a format once normalised."""
+    return pattern.fullmatch(normalise(postcode)) is not None
+
+
+def _record(postcode: str) -> bytes | None:
+    """Returns the fixed-width record for a postcode, or None if it can't be stored."""
+    key = normalise(postcode)
+    if not key or len(key) > WIDTH or not key.isascii() or not key.isalnum():
+        return None
+    return key.encode("ascii").ljust(WIDTH)
+
+
+def read_postcodes(csv_path: str):
+    """Yields the live postcodes in an ONS Postcode Directory or Code-Point Open CSV file.
+
+    Files with a header use its postcode column and skip rows with a termination date;
+    files without one use the first column."""
+    with open(csv_path, "r", encoding="utf-8", newline="") as f:
+        rows = csv.reader(f)
+        first = next(rows, None)
+        if first is None:
+            return
+        header = [name.strip().lower() for name in first]
+        column = next((header.index(name) for name in POSTCODE_COLUMNS if name in header), None)
+        terminated = header.index("doterm") if "doterm" in header else None
+        if column is None:
+            column = 0
+            yield first[0]
+        for row in rows:
+            if row and not (terminated is not None and row[terminated].strip()):
+                yield row[column]
+
+
+def build_index(postcodes, index_path: str) -> int:
+    """Writes a sorted, de-duplicated index of postcodes to a file, returning its size."""
+    records = sorted({record for record in map(_record, postcodes) if record})
+    with open(index_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(records), WIDTH))
+        f.write(b"".join(records))
+    return len(records)
+
+
+class PostcodeIndex:
+    """Looks postcodes up by binary search over a memory-mapped index file.
+
+    The file is mapped read-only, so every process using it shares the same pages."""
+
+    def __init__(self, index_path: str):
+        with open(index_path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, width = HEADER.unpack_from(self.data)
+        if magic != MAGIC or width != WIDTH:
+            self.data.close()
+            raise ValueError("Not a postcode index file.")
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _key(self, position: int) -> bytes:
+        """Returns the record stored at a position."""
+        start = HEADER.size + position * WIDTH
+        return self.data[start:start + WIDTH]
+
+    def _bisect(self, record: bytes) -> int:
+        """Returns the first position whose record is not less than the given one."""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < record:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def __contains__(self, postcode: str) -> bool:
+        record = _record(postcode)
+        if record is None:
+            return False
+        position = self._bisect(record)
+        return position < self.count and self._key(position) == record
+
+    def complete(self, postcode_start: str, limit: int = 10) -> list[str]:
+        """Returns up to limit indexed postcodes starting with a prefix, in sorted order."""
+        prefix = normalise(postcode_start).encode("ascii", "replace")
+        if not prefix:
+            return []
+        completions = []
+        position = self._bisect(prefix)
+        while position < self.count and len(completions) < limit:
+            key = self._key(position)
+            if not key.startswith(prefix):
+                break
+            completions.append(display(key.decode("ascii").rstrip()))
+            position += 1
+        return completions
+
+    def close(self):
+        """Unmaps the index file."""
+        self.data.close()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Build a postcode index from a postcode CSV file.")
+    parser.add_argument("csv", help="An ONSPD or Code-Point Open CSV file.")
+    parser.add_argument("index", help="Where to write the index.")
+    args = parser.parse_args()
+    print(f"Indexed {build_index(read_postcodes(args.csv), args.index)} postcodes.")
@@ -0,0 +1,172 @@
+"""Counters and timers for the cache and HTTP hot paths, reported to a pluggable sink."""
+
+import threading
+import time
+from contextlib import nullcontext
+
+_sink = None  # pylint: disable=invalid-name
+NULL_TIMER = nullcontext()
+
+
+def get_sink():
+    """Returns the sink receiving metrics, or None if instrumentation is disabled."""
+    return _sink
+
+
+def set_sink(sink):
+    """Sends metrics to a sink; None disables instrumentation."""
+    global _sink  # pylint: disable=global-statement
+    _sink = sink
+
+
+def count(name: str, value: float = 1, **labels):
+    """Adds to a counter."""
+    if _sink is not None:
+        _sink.count(name, value, labels)
+
+
+def observe(name: str, seconds: float, **labels):
+    """Records a duration for a timer."""
+    if _sink is not None:
+        _sink.observe(name, seconds, labels)
+
+
+class Timer:
+    """Times a block and records the duration when it exits."""
+
+    __slots__ = ("sink", "name", "labels", "started")
+
+    def __init__(self, sink, name: str, labels: dict):
+        self.sink = sink
+        self.name = name
+        self.labels = labels
+        self.started = 0.0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.sink.observe(self.name, time.perf_counter() - self.started, self.labels)
+
+
+def timed(name: str, **labels):
+    """Returns a context manager timing a block, or a shared no-op one when disabled."""
+    if _sink is None:
+        return NULL_TIMER
+    return Timer(_sink, name, labels)
+
+
+def _labels(labels) -> str:
+    """Formats labels the way Prometheus does, or as an empty string if there are none."""
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+class MemorySink:
+    """Keeps counter totals and timer statistics in memory, for tests and summaries."""
+
+    def __init__(self):
+        self.counters = {}
+        self.timers = {}
+        self.lock = threading.Lock()
+
+    def count(self, name: str, value: float, labels: dict):
+        """Adds to a counter."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, labels: dict):
+        """Records a duration as a count, a total and a maximum."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            calls, total, longest = self.timers.get(key, (0, 0.0, 0.0))
+            self.timers[key] = (calls + 1, total + seconds, max(longest, seconds))
+
+    def value(self, name: str, **labels) -> float:
+        """Returns a counter's total across every label set matching the given labels."""
+        with self.lock:
+            return sum(value for (key, key_labels), value in self.counters.items()
+                       if key == name and labels.items() <= dict(key_labels).items())
+
+    def calls(self, name: str, **labels) -> int:
+        """Returns how many durations a timer has recorded for the matching label sets."""
+        with self.lock:
+            return sum(calls for (key, key_labels), (calls, _, _) in self.timers.items()
+                       if key == name and labels.items() <= dict(key_labels).items())
+
+    def summary(self) -> str:
+        """Returns every counter and timer as readable lines, sorted by name."""
+        with self.lock:
+            lines = [f"{name}{_labels(labels)} {value:g}"
+                     for (name, labels), value in sorted(self.counters.items())]
+            lines += [f"{name}{_labels(labels)} calls={calls} total={total * 1000:.2f}ms "
+                      f"mean={total / calls * 1000:.3f}ms max={longest * 1000:.3f}ms"
+                      for (name, labels), (calls, total, longest) in sorted(self.timers.items())]
+        return "\n".join(lines)
+
+    def clear(self):
+        """Forgets every recorded value."""
+        with self.lock:
+            self.counters.clear()
+            self.timers.clear()
+
+
+class PrometheusSink(MemorySink):
+    """Collects metrics in memory and renders them in the Prometheus text format.
+
+    Counters become name_total counters and timers become name_seconds summaries, all
+    prefixed with prefix."""
+
+    def __init__(self, prefix: str = "postcode_"):
+        super().__init__()
+        self.prefix = prefix
+
+    def render(self) -> str:
+        """Returns the metrics in the Prometheus text exposition format."""
+        with self.lock:
+            counters = sorted(self.counters.items())
+            timers = sorted(self.timers.items())
+        lines = [f"{self.prefix}{name}_total{_labels(labels)} {value:g}"
+                 for (name, labels), value in counters]
+        summaries = []
+        for (name, labels), (calls, total, _) in timers:
+            metric = f"{self.prefix}{name}_seconds"
+            summaries.append(f"{metric}_count{_labels(labels)} {calls}")
+            summaries.append(f"{metric}_sum{_labels(labels)} {total:.6f}")
+        return "\n".join(_typed(lines, "counter") + _typed(summaries, "summary")) + "\n"
+
+
+def _typed(lines: list[str], kind: str) -> list[str]:
+    """Inserts a TYPE comment before the first sample of each metric."""
+    typed = []
+    seen = set()
+    for line in lines:
+        metric = line.split("{")[0].split(" ")[0]
+        if kind == "summary":
+            metric = metric.rsplit("_", 1)[0]
+        if metric not in seen:
+            seen.add(metric)
+            typed.append(f"# TYPE {metric} {kind}")
+        typed.append(line)
+    return typed
+
+
+class LoggingSink:
+    """Logs every counter increment and duration as it happens."""
+
+    def __init__(self, logger=None, level: int | None = None):
+        import logging  # pylint: disable=import-outside-toplevel
+        self.logger = logger or logging.getLogger("postcode.metrics")
+        self.level = logging.DEBUG if level is None else level
+
+    def count(self, name: str, value: float, labels: dict):
+        """Logs a counter increment."""
+        self.logger.log(self.level, "%s%s +%g", name, _labels(sorted(labels.items())), value)
+
+    def observe(self, name: str, seconds: float, labels: dict):
+        """Logs a duration in milliseconds."""
+        self.logger.log(self.level, "%s%s %.3fms", name, _labels(sorted(labels.items())),
+                        seconds * 1000)
@@ -0,0 +1,196 @@
+"""A local stand-in for the Postcode API, used by benchmarks and multi-process tests."""
+
+import json
+import math
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+from postcode_geo import distance
+
+AREAS = ["AB", "BN", "CF", "EH", "LS", "ME", "NE", "SW", "TN", "YO"]
+
+
+def make_postcodes(count: int) -> list[str]:
+    """Returns a deterministic list of well-formed postcodes."""
+    postcodes = []
+    for i in range(count):
+        area = AREAS[i % len(AREAS)]
+        district = (i // len(AREAS)) % 20 + 1
+        sector = (i // (len(AREAS) * 20)) % 10
+        unit = i // (len(AREAS) * 200)
+        letters = chr(65 + unit // 26 % 26) + chr(65 + unit % 26)
+        postcodes.append(f"{area}{district} {sector}{letters}")
+    return postcodes
+
+
+def make_locations(postcodes: list[str]) -> dict:
+    """Places each postcode on a grid of points roughly 50m apart around London."""
+    side = max(1, math.isqrt(len(postcodes)))
+    return {postcode: (51.5 + (i // side) * 0.00045, -0.1 + (i % side) * 0.00072)
+            for i, postcode in enumerate(postcodes)}
+
+
+class StubData:  # pylint: disable=too-few-public-methods
+    """The postcodes served by a stub server."""
+
+    def __init__(self, postcodes: list[str]):
+        self.postcodes = sorted(postcodes)
+        self.valid = set(postcodes)
+        self.locations = make_locations(postcodes)
+
+    def details(self, postcode: str) -> dict | None:
+        """Returns the record the API would give for a postcode, or None."""
+        key = " ".join(postcode.upper().split())
+        if key not in self.valid:
+            return None
+        outcode, incode = key.split(" ")
+        lat, long = self.locations[key]
+        return {"postcode": key, "outcode": outcode, "incode": incode,
+                "latitude": lat, "longitude": long}
+
+    def complete(self, prefix: str) -> list[str] | None:
+        """Returns up to ten postcodes starting with a prefix, or None."""
+        prefix = prefix.upper().replace(" ", "")
+        matches = [postcode for postcode in self.postcodes
+                   if postcode.replace(" ", "").startswith(prefix)][:10]
+        return matches or None
+
+    def nearest(self, lat: float, long: float, radius: float = 100, limit: int = 10):
+        """Returns the postcodes within a radius of a point, nearest first, or None."""
+        found = []
+        for postcode, (p_lat, p_long) in self.locations.items():
+            metres = distance(lat, long, p_lat, p_long)
+            if metres <= radius:
+                found.append({**self.details(postcode), "distance": metres})
+        found.sort(key=lambda item: item["distance"])
+        return found[:limit] or None
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers the Postcode API endpoints used by postcode_functions."""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """Keeps the stub quiet."""
+
+    def _send(self, status: int, body: dict, headers: dict | None = None):
+        """Writes a JSON response."""
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _delay(self) -> bool:
+        """Counts the request and waits for the configured latency.
+
+        Returns False, having sent a 429 response, if the request is one to throttle."""
+        server = self.server
+        with server.lock:
+            server.request_count += 1
+            throttled = server.throttle_every and server.request_count % server.throttle_every == 0
+            server.throttled_count += bool(throttled)
+        if throttled:
+            self._send(429, {"status": 429, "error": "Too many requests"},
+                       {"Retry-After": str(server.retry_after)})
+            return False
+        if server.latency:
+            time.sleep(server.latency)
+        return True
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Handles validation, autocomplete and reverse geocoding lookups."""
+        if not self._delay():
+            return
+        data = self.server.data
+        url = urlparse(self.path)
+        match = re.fullmatch(r"/postcodes/(.+)/(validate|autocomplete)", url.path)
+        if match and match.group(2) == "validate":
+            result = data.details(unquote(match.group(1))) is not None
+            self._send(200, {"status": 200, "result": result})
+        elif match:
+            self._send(200, {"status": 200, "result": data.complete(unquote(match.group(1)))})
+        elif url.path == "/postcodes":
+            query = parse_qs(url.query)
+            result = data.nearest(float(query["lat"][0]), float(query["lon"][0]),
+                                  float(query.get("radius", [100])[0]),
+                                  int(query.get("limit", [10])[0]))
+            self._send(200, {"status": 200, "result": result})
+        else:
+            self._send(404, {"status": 404, "error": "Resource not found"})
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """Handles bulk postcode and geolocation lookups."""
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or "{}")
+        if not self._delay():
+            return
+        data = self.server.data
+        if "geolocations" in body:
+            result = [{"query": point,
+                       "result": data.nearest(point["latitude"], point["longitude"],
+                                              point.get("radius", 100), point.get("limit", 10))}
+                      for point in body["geolocations"]]
+        else:
+            result = [{"query": postcode, "result": data.details(postcode)}
+                      for postcode in body.get("postcodes", [])]
+        self._send(200, {"status": 200, "result": result})
+
+
+class StubServer:
+    """Runs a stub Postcode API on a local port in a background thread.
+
+    With throttle_every set, every nth request is answered with a 429 and a Retry-After
+    header of retry_after seconds."""
+
+    def __init__(self, postcodes: list[str] | None = None, latency: float = 0.0,
+                 throttle_every: int = 0, retry_after: float = 0):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        self.server.daemon_threads = True
+        self.server.data = StubData(postcodes if postcodes is not None else make_postcodes(1000))
+        self.server.latency = latency
+        self.server.lock = threading.Lock()
+        self.server.request_count = 0
+        self.server.throttle_every = throttle_every
+        self.server.retry_after = retry_after
+        self.server.throttled_count = 0
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        """The base URL of the running server."""
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def request_count(self) -> int:
+        """The number of requests the server has received."""
+        return self.server.request_count
+
+    @property
+    def throttled_count(self) -> int:
+        """The number of requests the server has answered with a 429."""
+        return self.server.throttled_count
+
+    def start(self):
+        """Starts serving requests."""
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stops the server and closes its socket."""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,61 @@
+"""Fills the cache ahead of time with every postcode in some outward codes or areas.
+
+Postcodes are found by autocompleting ever longer prefixes until each returns fewer
+than the API's cap of completions, then validated and detailed with bulk lookups.
+Everything goes through the cache, so an interrupted warm-up resumes where it stopped."""
+
+import re
+import postcode_functions as functions
+from postcode_index import canonical, normalise
+
+ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+CHUNK_SIZE = functions.BULK_LIMIT * functions.BULK_WORKERS
+
+
+def in_area(postcode: str, area: str) -> bool:
+    """Returns whether a postcode is in an outward code, such as "TN12", or an area, "TN"."""
+    outward = canonical(postcode).split(" ", maxsplit=1)[0]
+    if area.isalpha():
+        return re.match(r"[A-Z]*", outward).group() == area
+    return outward == area
+
+
+def enumerate_postcodes(area: str, executor) -> list[str]:
+    """Returns every postcode in an outward code or area, sorted, using autocomplete.
+
+    Prefixes whose completions hit COMPLETION_LIMIT are extended by one character at a
+    time, level by level, with the lookups for each level run on the executor."""
+    area = normalise(area)
+    found = set()
+    prefixes = [area]
+    while prefixes:
+        extended = []
+        completions = executor.map(functions.get_postcode_completions, prefixes)
+        for prefix, postcodes in zip(prefixes, completions):
+            found.update(postcodes or [])
+            if len(postcodes or []) >= functions.COMPLETION_LIMIT and len(prefix) < 7:
+                extended += [prefix + character for character in ALPHABET]
+        prefixes = extended
+    return sorted(postcode for postcode in found if in_area(postcode, area))
+
+
+def warm_cache(areas, progress=None) -> dict:
+    """Caches the completions, validity and details of every postcode in some areas.
+
+    Areas are outward codes or postcode areas. progress, if given, is called with the
+    area, the postcodes looked up so far and the total after each chunk. Returns the
+    number of postcodes found in each area."""
+    found = {}
+    with functions.bulk_executor() as executor:
+        for area in areas:
+            area = normalise(area)
+            postcodes = enumerate_postcodes(area, executor)
+            if progress:
+                progress(area, 0, len(postcodes))
+            for start in range(0, len(postcodes), CHUNK_SIZE):
+                functions.get_postcodes_details(postcodes[start:start + CHUNK_SIZE])
+                functions.flush_cache()
+                if progress:
+                    progress(area, min(start + CHUNK_SIZE, len(postcodes)), len(postcodes))
+            found[area] = len(postcodes)
+    return found
@@ -0,0 +1,88 @@
+"""Tests for the asynchronous postcode functions."""
+
+# pylint: skip-file
+
+import asyncio
+import time
+import pytest
+import requests as req
+
+import postcode_async
+from postcode_cache import JsonCacheStore
+from postcode_functions import load_cache, set_cache_store
+
+
+def test_async_validate_postcode_caches_result(requests_mock):
+    requests_mock.get("https://api.postcodes.io/postcodes/ABC123/validate",
+                      status_code=200, json={"result": True})
+    assert asyncio.run(postcode_async.validate_postcode("ABC123")) is True
+    requests_mock.reset_mock()
+    assert asyncio.run(postcode_async.validate_postcode("ABC123")) is True
+    assert requests_mock.call_count == 0
+    assert load_cache()["ABC123"]["valid"] is True
+
+
+def test_async_validate_postcode_rejects_non_string():
+    with pytest.raises(TypeError, match="Function expects a string."):
+        asyncio.run(postcode_async.validate_postcode(42))
+
+
+def test_async_get_postcode_for_location_returns_result(requests_mock):
+    requests_mock.get("https://api.postcodes.io/postcodes?lon=1.0&lat=2.0",
+                      status_code=200, json={"result": [{"postcode": "P0STC0DE"}]})
+    assert asyncio.run(postcode_async.get_postcode_for_location(2.0, 1.0)) == "P0STC0DE"
+
+
+def test_async_get_postcode_completions_raises_error_with_500_codes(requests_mock):
+    requests_mock.get("https://api.postcodes.io/postcodes/abc/autocomplete", status_code=500)
+    with pytest.raises(req.RequestException, match="Unable to access API."):
+        asyncio.run(postcode_async.get_postcode_completions("abc"))
+
+
+def test_async_get_postcodes_details_returns_response_dict(requests_mock):
+    requests_mock.post("https://api.postcodes.io/postcodes",
+                       status_code=200, json={"response": "value"})
+    assert asyncio.run(postcode_async.get_postcodes_details([])) == {"response": "value"}
+
+
+def test_async_client_fans_out_lookups(requests_mock):
+    for i in range(30):
+        requests_mock.get(f"https://api.postcodes.io/postcodes/PC{i}/validate",
+                          status_code=200, json={"result": i % 2 == 0})
+
+    async def run():
+        client = postcode_async.AsyncPostcodeClient(max_concurrency=5)
+        return await asyncio.gather(*(client.validate_postcode(f"PC{i}") for i in range(30)))
+
+    assert asyncio.run(run()) == [i % 2 == 0 for i in range(30)]
+    assert len(load_cache()) == 30
+
+
+def test_async_cache_reads_do_not_block_the_event_loop(tmp_path):
+    class SlowStore(JsonCacheStore):
+        def get(self, key):
+            time.sleep(0.2)
+            return super().get(key)
+
+    store = SlowStore(str(tmp_path / "cache.json"))
+    store.save({"AB1 0AA": {"valid": True, "valid_at": time.time()}})
+    set_cache_store(store)
+
+    async def main():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.create_task(tick())
+        assert await postcode_async.validate_postcode("AB1 0AA") is True
+        ticker.cancel()
+        return ticks
+
+    try:
+        assert asyncio.run(main()) >= 5
+    finally:
+        set_cache_store(None)
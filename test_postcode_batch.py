@@ -0,0 +1,57 @@
+"""Tests for the multi-process batch runner."""
+
+# pylint: skip-file
+
+import os
+
+import pytest
+
+from postcode_batch import merge_cache_shards, run_sharded, shard_of, shard_paths
+from postcode_cache import JsonCacheStore, SqliteCacheStore
+from postcode_stub import StubServer, make_postcodes
+
+
+def test_shard_of_keeps_an_outward_code_together():
+    assert shard_of("tn120aa", 4) == shard_of("TN12 9ZZ", 4)
+    assert {shard_of(postcode, 4) for postcode in make_postcodes(200)} == {0, 1, 2, 3}
+
+
+def test_run_sharded_returns_results_in_input_order_and_merges_shards(tmp_path):
+    cache_path = str(tmp_path / "cache.json")
+    JsonCacheStore(cache_path).save({"@51.5000,-0.1000": {"postcode": "AB1 0AA"}})
+    postcodes = make_postcodes(300)
+    inputs = postcodes[::-1] + ["ZZ99 9ZZ", "tn1 0aa"]
+    with StubServer(postcodes) as server:
+        results = run_sharded(inputs, "validate", 3, cache_path=cache_path,
+                              base_url=server.url)
+        assert results == [True] * 300 + [False, True]
+        requests = server.request_count
+        details = run_sharded(inputs[:5], "details", 2, cache_path=cache_path,
+                              base_url=server.url)
+        assert server.request_count == requests
+    assert [item["postcode"] for item in details] == inputs[:5]
+    assert not any(os.path.exists(path) for path in shard_paths(cache_path, 3))
+    cache = JsonCacheStore(cache_path).load()
+    assert len(cache) == 302 and cache["TN1 0AA"]["valid"]
+
+
+def test_run_sharded_allows_less_than_one_request_per_second_per_worker(tmp_path):
+    postcodes = make_postcodes(20)
+    with StubServer(postcodes) as server:
+        results = run_sharded(postcodes, "validate", 4, cache_path=str(tmp_path / "cache"),
+                              rate=2, base_url=server.url)
+    assert results == [True] * 20
+    with pytest.raises(ValueError):
+        run_sharded(postcodes, rate=0)
+
+
+def test_merge_cache_shards_keeps_the_newest_fields(tmp_path):
+    cache_path = str(tmp_path / "cache.json")
+    JsonCacheStore(cache_path).save({"AB1 0AA": {"valid": False, "valid_at": 1,
+                                                 "completions": ["AB1 0AA"]}})
+    paths = shard_paths(cache_path, 2)
+    SqliteCacheStore(paths[0]).save({"AB1 0AA": {"valid": True, "valid_at": 2}})
+    assert merge_cache_shards(paths, cache_path) == 1
+    assert JsonCacheStore(cache_path).load() == {
+        "AB1 0AA": {"valid": True, "valid_at": 2, "completions": ["AB1 0AA"]}}
+    assert not os.path.exists(paths[0])
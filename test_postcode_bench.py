@@ -0,0 +1,14 @@
+"""Tests for the benchmark harness."""
+
+# pylint: skip-file
+
+from postcode_bench import bench_functions
+
+
+def test_bench_functions_reports_every_function_cold_and_warm():
+    results = bench_functions(calls=10, latency=0, cache_sizes=[100], batch_size=5)
+    assert len(results) == 14
+    assert {(row["function"], row["cache"]) for row in results} >= {
+        ("validate_postcode", "cold"), ("validate_postcode", "warm"),
+        ("validate_postcodes", "cold"), ("get_postcodes_for_locations", "warm")}
+    assert all(row["ops_per_sec"] > 0 and row["p99_ms"] >= row["p50_ms"] for row in results)
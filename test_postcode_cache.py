@@ -4,10 +4,21 @@
 
 import os
 import json
+import multiprocessing
+import threading
+import time
 import pytest
+import postcode_functions
 from postcode_functions import (
-    validate_postcode, get_postcode_completions, get_postcodes_details, load_cache, save_cache, CACHE_FILE
+    validate_postcode, get_postcode_completions, get_postcodes_details, load_cache, save_cache, CACHE_FILE,
+    set_cache_store, validate_postcodes
 )
+from postcode_cache import (CompactCacheStore, JsonCacheStore, MemoryCacheStore, SqliteCacheStore,
+                            WriteBehindCacheStore, compact_cache, convert_cache, detect_format,
+                            open_cache_store)
+from postcode_client import PostcodeClient
+from postcode_functions import flush_cache, set_client
+from postcode_stub import StubServer, make_postcodes
 
 
 def test_validate_postcode_caches_result(requests_mock):
@@ -118,3 +129,422 @@ def test_save_and_load_cache_roundtrip_param(data):
     save_cache(data)
     loaded = load_cache()
     assert loaded == data
+
+
+def test_sqlite_store_migrates_json_cache_once(tmp_path):
+    save_cache({"A": {"valid": True}})
+    store = SqliteCacheStore(str(tmp_path / "cache.db"), migrate_from=CACHE_FILE)
+    assert store.get("A") == {"valid": True}
+    save_cache({"B": {"valid": False}})
+    store.migrate(CACHE_FILE)
+    assert store.get("B") is None
+    store.close()
+
+
+def test_sqlite_store_merges_fields_per_key(tmp_path, requests_mock):
+    requests_mock.get(
+        "https://api.postcodes.io/postcodes/ZZ1 1ZZ/validate",
+        status_code=200, json={"result": True})
+    requests_mock.get(
+        "https://api.postcodes.io/postcodes/ZZ1 1ZZ/autocomplete",
+        status_code=200, json={"result": ["ZZ1 1ZZ"]})
+    store = SqliteCacheStore(str(tmp_path / "cache.db"))
+    set_cache_store(store)
+    try:
+        validate_postcode("ZZ1 1ZZ")
+        get_postcode_completions("ZZ1 1ZZ")
+        entry = store.get("ZZ1 1ZZ")
+        assert entry["valid"] is True and entry["completions"] == ["ZZ1 1ZZ"]
+        assert list(load_cache()) == ["ZZ1 1ZZ"]
+        assert not os.path.exists(CACHE_FILE)
+    finally:
+        set_cache_store(None)
+        store.close()
+
+
+def test_sqlite_store_is_safe_to_share_between_threads(tmp_path):
+    store = SqliteCacheStore(str(tmp_path / "cache.db"))
+
+    def write(thread):
+        for i in range(300):
+            store.update(f"K{thread} {i}", {"valid": True})
+            store.get(f"K{thread} {i}")
+
+    threads = [threading.Thread(target=write, args=(thread,)) for thread in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(store.load()) == 2400
+
+
+def test_memory_store_evicts_least_recently_used(tmp_path):
+    backing = JsonCacheStore(str(tmp_path / "cache.json"))
+    backing.save({"A": {"valid": True}, "B": {"valid": False}, "C": {"valid": True}})
+    store = MemoryCacheStore(backing, max_entries=2)
+    store.get("A")
+    store.get("B")
+    store.get("A")
+    store.get("C")
+    assert list(store.entries) == ["A", "C"]
+    assert store.stats()["evictions"] == 1
+    assert store.get("A") == {"valid": True}
+    assert store.stats()["hits"] == 2
+    assert store.stats()["misses"] == 3
+
+
+def test_memory_store_sees_changes_from_other_processes(tmp_path):
+    backing = JsonCacheStore(str(tmp_path / "cache.json"))
+    backing.save({"A": {"valid": True}})
+    store = MemoryCacheStore(backing)
+    assert store.get("A") == {"valid": True}
+    JsonCacheStore(backing.path).save({"A": {"valid": False, "extra": 1}})
+    assert store.get("A") == {"valid": False, "extra": 1}
+
+
+def test_memory_store_parses_json_file_once_for_distinct_keys(tmp_path, monkeypatch):
+    backing = JsonCacheStore(str(tmp_path / "cache.json"))
+    backing.save({f"K{i}": {"valid": True} for i in range(200)})
+    loads = []
+    load = JsonCacheStore.load
+    monkeypatch.setattr(JsonCacheStore, "load", lambda self: loads.append(1) or load(self))
+    store = MemoryCacheStore(backing)
+    assert all(store.get(f"K{i}") == {"valid": True} for i in range(200))
+    assert len(loads) == 1
+
+
+def test_validate_postcode_does_not_reread_cache_file_on_hits(requests_mock, monkeypatch):
+    requests_mock.get(
+        "https://api.postcodes.io/postcodes/ABC123/validate",
+        status_code=200, json={"result": True})
+    validate_postcode("ABC123")
+    monkeypatch.setattr(JsonCacheStore, "load", lambda self: pytest.fail("cache file re-read"))
+    assert validate_postcode("ABC123") is True
+
+
+def test_get_postcodes_details_caches_each_postcode(requests_mock):
+    requests_mock.post("https://api.postcodes.io/postcodes", json={"status": 200, "result": [
+        {"query": "AB1 1AA", "result": {"postcode": "AB1 1AA"}},
+        {"query": "ZZ1 1ZZ", "result": None}]})
+    get_postcodes_details(["AB1 1AA", "ZZ1 1ZZ"])
+    requests_mock.reset_mock()
+    assert get_postcodes_details(["ZZ1 1ZZ", "AB1 1AA", "ZZ1 1ZZ"]) == {"status": 200, "result": [
+        {"query": "ZZ1 1ZZ", "result": None},
+        {"query": "AB1 1AA", "result": {"postcode": "AB1 1AA"}},
+        {"query": "ZZ1 1ZZ", "result": None}]}
+    assert requests_mock.call_count == 0
+    assert validate_postcode("AB1 1AA") is True
+    assert validate_postcode("ZZ1 1ZZ") is False
+
+
+def test_get_postcodes_details_refetches_expired_entries(requests_mock, monkeypatch):
+    requests_mock.post("https://api.postcodes.io/postcodes", json={"status": 200, "result": [
+        {"query": "AB1 1AA", "result": {"postcode": "AB1 1AA"}}]})
+    get_postcodes_details(["AB1 1AA"])
+    monkeypatch.setitem(postcode_functions.CACHE_TTLS, "details", -1)
+    get_postcodes_details(["AB1 1AA"])
+    assert requests_mock.call_count == 2
+
+
+def _details_reply(request, context):
+    return {"status": 200, "result": [{"query": postcode, "result": {"postcode": postcode}}
+                                      for postcode in request.json()["postcodes"]]}
+
+
+def test_get_postcodes_details_chunks_large_lists(requests_mock):
+    requests_mock.post("https://api.postcodes.io/postcodes", json=_details_reply)
+    postcodes = [f"PC{i}" for i in range(250)]
+    response = get_postcodes_details(postcodes)
+    assert requests_mock.call_count == 3
+    assert [item["query"] for item in response["result"]] == postcodes
+    assert [item["result"]["postcode"] for item in response["result"]] == postcodes
+
+
+def test_get_postcodes_details_never_posts_more_than_the_bulk_limit(requests_mock):
+    requests_mock.post("https://api.postcodes.io/postcodes", json=_details_reply)
+    postcodes = [f"PC{i % 60}" for i in range(150)]
+    response = get_postcodes_details(postcodes)
+    assert all(len(request.json()["postcodes"]) <= 100
+               for request in requests_mock.request_history)
+    assert [item["query"] for item in response["result"]] == postcodes
+
+
+def _validate_in_child(url, postcodes):
+    set_cache_store(None)
+    set_client(PostcodeClient(base_url=url))
+    for postcode in postcodes:
+        validate_postcode(postcode)
+
+
+def test_concurrent_processes_do_not_lose_cache_entries():
+    postcodes = make_postcodes(200)
+    context = multiprocessing.get_context("fork")
+    with StubServer(postcodes) as server:
+        workers = [context.Process(target=_validate_in_child,
+                                   args=(server.url, postcodes[i::8] + ["ZZ99 9ZZ"]))
+                   for i in range(8)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    assert all(worker.exitcode == 0 for worker in workers)
+    cache = load_cache()
+    assert sorted(cache) == sorted(postcodes + ["ZZ99 9ZZ"])
+    assert all(cache[postcode]["valid"] for postcode in postcodes)
+
+
+def test_write_behind_store_flushes_full_batches(tmp_path):
+    backing = JsonCacheStore(str(tmp_path / "cache.json"))
+    store = WriteBehindCacheStore(backing, max_batch=3, interval=60)
+    try:
+        store.update("A", {"valid": True})
+        store.update("B", {"valid": False})
+        assert backing.load() == {}
+        assert store.get("A") == {"valid": True}
+        assert store.stats()["queue_depth"] == 2
+        store.update("C", {"valid": True})
+        for _ in range(100):
+            if store.stats()["flushes"]:
+                break
+            time.sleep(0.01)
+        assert backing.load() == {"A": {"valid": True}, "B": {"valid": False}, "C": {"valid": True}}
+        assert store.stats()["entries_flushed"] == 3
+    finally:
+        store.close()
+
+
+def test_write_behind_store_flushes_on_interval_and_close(tmp_path):
+    backing = JsonCacheStore(str(tmp_path / "cache.json"))
+    store = WriteBehindCacheStore(backing, max_batch=100, interval=0.05)
+    store.update("A", {"valid": True})
+    time.sleep(0.3)
+    assert backing.get("A") == {"valid": True}
+    store.update("B", {"completions": ["B1"]})
+    store.close()
+    assert backing.get("B") == {"completions": ["B1"]}
+
+
+def test_write_behind_store_retries_after_a_failed_flush(tmp_path, monkeypatch):
+    backing = JsonCacheStore(str(tmp_path / "cache.json"))
+    write = backing.update_many
+    failures = []
+
+    def update_many(entries):
+        if not failures:
+            failures.append(entries)
+            raise OSError("disk full")
+        write(entries)
+
+    monkeypatch.setattr(backing, "update_many", update_many)
+    store = WriteBehindCacheStore(backing, interval=0.05)
+    try:
+        store.update("A", {"valid": True})
+        for _ in range(100):
+            if backing.get("A"):
+                break
+            time.sleep(0.01)
+        assert backing.get("A") == {"valid": True}
+        assert store.thread.is_alive() and store.stats()["flush_errors"] == 1
+    finally:
+        store.close()
+
+
+def test_write_behind_store_serves_entries_while_they_are_being_flushed(tmp_path,
+                                                                        monkeypatch):
+    backing = JsonCacheStore(str(tmp_path / "cache.json"))
+    write = backing.update_many
+    started = threading.Event()
+    release = threading.Event()
+
+    def update_many(entries):
+        started.set()
+        release.wait(5)
+        write(entries)
+
+    monkeypatch.setattr(backing, "update_many", update_many)
+    store = WriteBehindCacheStore(backing, interval=60)
+    try:
+        store.update("A", {"valid": True})
+        flusher = threading.Thread(target=store.flush)
+        flusher.start()
+        started.wait(5)
+        assert store.get("A") == {"valid": True}
+        release.set()
+        flusher.join()
+        assert store.get("A") == {"valid": True} and store.flushing == {}
+    finally:
+        release.set()
+        store.close()
+
+
+def test_flush_cache_persists_buffered_misses(requests_mock, tmp_path):
+    requests_mock.get("https://api.postcodes.io/postcodes/ABC123/validate",
+                      status_code=200, json={"result": True})
+    backing = JsonCacheStore(str(tmp_path / "cache.json"))
+    store = WriteBehindCacheStore(backing, interval=60)
+    set_cache_store(MemoryCacheStore(store))
+    try:
+        assert validate_postcode("ABC123") is True
+        assert backing.load() == {}
+        flush_cache()
+        assert backing.load()["ABC123"]["valid"] is True
+    finally:
+        set_cache_store(None)
+        store.close()
+
+
+def wait_for_refreshes():
+    for _ in range(200):
+        if not postcode_functions._refreshing:
+            return
+        time.sleep(0.01)
+
+
+def test_validate_postcode_serves_stale_entries_while_refreshing(requests_mock, monkeypatch):
+    save_cache({"ABC123": {"valid": False, "valid_at": 0}})
+    requests_mock.get("https://api.postcodes.io/postcodes/ABC123/validate",
+                      status_code=200, json={"result": True})
+    monkeypatch.setitem(postcode_functions.CACHE_TTLS, "valid", 60)
+    monkeypatch.setitem(postcode_functions.STALE_TTLS, "valid", 10**10)
+    assert validate_postcode("ABC123") is False
+    wait_for_refreshes()
+    assert requests_mock.call_count == 1
+    assert validate_postcode("ABC123") is True
+    assert requests_mock.call_count == 1
+
+
+def test_validate_postcode_refetches_expired_entries(requests_mock, monkeypatch):
+    save_cache({"ABC123": {"valid": False, "valid_at": 0}})
+    requests_mock.get("https://api.postcodes.io/postcodes/ABC123/validate",
+                      status_code=200, json={"result": True})
+    monkeypatch.setitem(postcode_functions.CACHE_TTLS, "valid", 60)
+    monkeypatch.setitem(postcode_functions.STALE_TTLS, "valid", 60)
+    assert validate_postcode("ABC123") is True
+
+
+def test_stale_completions_are_refreshed_once(requests_mock, monkeypatch):
+    save_cache({"AB": {"completions": ["AB1 1AA"]}})
+    release = threading.Event()
+
+    def slow_reply(request, context):
+        release.wait(5)
+        return {"result": ["AB1 1AA", "AB1 2BB"]}
+
+    requests_mock.get("https://api.postcodes.io/postcodes/AB/autocomplete", json=slow_reply)
+    monkeypatch.setitem(postcode_functions.CACHE_TTLS, "completions", 60)
+    for _ in range(5):
+        assert get_postcode_completions("AB") == ["AB1 1AA"]
+    release.set()
+    wait_for_refreshes()
+    assert requests_mock.call_count == 1
+    assert get_postcode_completions("AB") == ["AB1 1AA", "AB1 2BB"]
+
+
+COMPACT_CASES = {
+    "AB1 0AA": {"valid": True, "valid_at": 1.5, "details": {"postcode": "AB1 0AA"}},
+    "AB1": {"completions": ["AB1 0AA", "AB1 0AB"], "completions_at": 2.0},
+    "ZZ9": {"completions": None},
+    "XX1 1XX": {"valid": False},
+    "ODD": {"valid": "yes", "completions": [1, 2]},
+    "NUL\x00KEY": {"valid": True},
+    "EMPTY": {},
+}
+
+
+def test_compact_store_roundtrips_every_field(tmp_path):
+    store = CompactCacheStore(str(tmp_path / "cache.bin"))
+    store.save(COMPACT_CASES)
+    assert store.load() == COMPACT_CASES
+    assert store.get("AB1") == COMPACT_CASES["AB1"]
+    assert store.get("NUL\x00KEY") == {"valid": True}
+    assert store.get("MISSING") is None
+
+
+def test_compact_store_shares_completion_strings(tmp_path):
+    store = CompactCacheStore(str(tmp_path / "cache.bin"))
+    store.save({"AB1 0AA": {"valid": True}, "AB1": {"completions": ["AB1 0AA"]},
+                "AB1 0": {"completions": ["AB1 0AA"]}})
+    cache = CompactCacheStore(store.path).load()
+    assert cache["AB1"]["completions"][0] is cache["AB1 0"]["completions"][0]
+
+
+def test_compact_store_merges_updates(tmp_path):
+    store = CompactCacheStore(str(tmp_path / "cache.bin"))
+    store.update("A", {"valid": True})
+    store.update("A", {"completions": ["A 1AA"]})
+    store.delete_many(["missing"])
+    assert store.get("A") == {"valid": True, "completions": ["A 1AA"]}
+
+
+def test_cache_format_is_detected(tmp_path):
+    path = str(tmp_path / "cache")
+    assert detect_format(path) == "json"
+    for cache_format, store_class in (("json", JsonCacheStore), ("compact", CompactCacheStore),
+                                      ("sqlite", SqliteCacheStore)):
+        convert_cache(path, path, cache_format)
+        assert detect_format(path) == cache_format
+        assert type(open_cache_store(path)) is store_class
+
+
+def test_convert_cache_in_place_keeps_entries(tmp_path):
+    path = str(tmp_path / "cache.json")
+    JsonCacheStore(path).save(COMPACT_CASES)
+    assert convert_cache(path, path, "compact") == len(COMPACT_CASES)
+    assert open(path, "rb").read(8) == b"PCCACHE\x00"
+    assert open_cache_store(path).load() == COMPACT_CASES
+    convert_cache(path, path, "sqlite")
+    assert open_cache_store(path).load() == COMPACT_CASES
+
+
+def test_compact_file_of_unknown_version_is_rejected(tmp_path):
+    store = CompactCacheStore(str(tmp_path / "cache.bin"))
+    store.save({"A": {"valid": True}})
+    data = bytearray(open(store.path, "rb").read())
+    data[8] = 99
+    open(store.path, "wb").write(data)
+    with pytest.raises(ValueError):
+        CompactCacheStore(store.path).load()
+
+
+def test_default_store_opens_compact_cache_file(requests_mock):
+    CompactCacheStore(CACHE_FILE).save({"ABC": {"valid": True, "valid_at": time.time()}})
+    set_cache_store(None)
+    assert validate_postcode("ABC") is True
+    assert not requests_mock.called
+
+
+def test_spellings_of_a_postcode_share_one_cache_entry(requests_mock):
+    requests_mock.get("https://api.postcodes.io/postcodes/TN12 0AA/validate",
+                      status_code=200, json={"result": True})
+    for postcode in ("tn120aa", "TN12 0AA", " TN12  0aa "):
+        assert validate_postcode(postcode) is True
+    assert validate_postcodes(["tn12 0aa"]) == {"tn12 0aa": True}
+    assert requests_mock.call_count == 1
+    flush_cache()
+    assert list(load_cache()) == ["TN12 0AA"]
+
+
+def test_get_postcodes_details_posts_each_canonical_postcode_once(requests_mock):
+    requests_mock.post("https://api.postcodes.io/postcodes", json={"status": 200, "result": [
+        {"query": "AB1 0AA", "result": {"postcode": "AB1 0AA"}}]})
+    response = get_postcodes_details(["ab10aa", "AB1 0AA"])
+    assert requests_mock.request_history[0].json() == {"postcodes": ["AB1 0AA"]}
+    assert response == {"status": 200, "result": [
+        {"query": "ab10aa", "result": {"postcode": "AB1 0AA"}},
+        {"query": "AB1 0AA", "result": {"postcode": "AB1 0AA"}}]}
+
+
+def test_compact_cache_merges_spellings_keeping_newest_fields(tmp_path):
+    path = str(tmp_path / "cache.json")
+    JsonCacheStore(path).save({
+        "tn120aa": {"valid": False, "valid_at": 1, "completions": ["TN12 0AA"]},
+        "TN12 0AA": {"valid": True, "valid_at": 2},
+        "tn12": {"completions": ["TN12 0AA"], "completions_at": 3},
+        "@51.0000,0.1000": {"postcode": "TN12 0AA", "fetched_at": 4},
+    })
+    assert compact_cache(path) == (4, 3)
+    assert JsonCacheStore(path).load() == {
+        "TN12 0AA": {"valid": True, "valid_at": 2, "completions": ["TN12 0AA"]},
+        "TN12": {"completions": ["TN12 0AA"], "completions_at": 3},
+        "@51.0000,0.1000": {"postcode": "TN12 0AA", "fetched_at": 4},
+    }
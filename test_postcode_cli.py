@@ -2,8 +2,14 @@
 
 # pylint: skip-file
 
+import json
+import os
+import subprocess
+import sys
 import pytest
 
+from postcode_stub import StubServer, make_postcodes
+
 
 def test_cli_requires_mode_argument(run_shell_command):
     """Checks if running the CLI tool without a --mode/-m argument displays an error."""
@@ -113,3 +119,51 @@ def test_cli_outputs_valid_completions(postcode, run_shell_command):
 
     for completion in output.splitlines():
         assert completion.startswith(postcode)
+
+
+@pytest.fixture()
+def stub_api():
+    with StubServer(make_postcodes(100)) as server:
+        yield server
+
+
+def run_cli(arguments, stub_api, stdin=""):
+    env = {**os.environ, "POSTCODE_API_URL": stub_api.url}
+    result = subprocess.run([sys.executable, "-W", "ignore", "postcode_cli.py", *arguments],
+                            input=stdin, capture_output=True, text=True, env=env)
+    return result.stdout, result.stderr
+
+
+def test_cli_batch_validates_stdin_as_csv(stub_api):
+    output, error = run_cli(["-m", "validate", "--batch", "-"], stub_api,
+                            " ab1 0aa \n\nZZ99 9ZZ\nBN1 0AA\n")
+    assert error == ""
+    assert output == "postcode,valid\nAB1 0AA,true\nZZ99 9ZZ,false\nBN1 0AA,true\n"
+    assert stub_api.request_count == 1
+
+
+def test_cli_batch_completes_file_as_json_lines(stub_api, tmp_path):
+    path = tmp_path / "prefixes.txt"
+    path.write_text("ab1 0a\nzz9\n")
+    output, error = run_cli(["-m", "complete", "-b", "-f", "jsonl", str(path)], stub_api)
+    assert error == ""
+    assert [json.loads(line) for line in output.splitlines()] == [
+        {"postcode": "AB1 0A", "completions": ["AB1 0AA"]},
+        {"postcode": "ZZ9", "completions": None}]
+
+
+def test_cli_batch_processes_inputs_larger_than_one_batch(stub_api):
+    postcodes = make_postcodes(100) * 3
+    output, _ = run_cli(["-m", "validate", "-b", "-f", "jsonl", "-"], stub_api,
+                        "\n".join(postcodes))
+    lines = output.splitlines()
+    assert len(lines) == 300
+    assert all(json.loads(line)["valid"] for line in lines)
+
+
+def test_cli_stats_prints_summary_to_stderr(stub_api):
+    output, error = run_cli(["-m", "validate", "--stats", "AB1 0AA"], stub_api)
+    assert output.strip() == "AB1 0AA is a valid postcode."
+    assert 'cache_misses{field="valid"} 1' in error
+    assert 'http_responses{method="GET",status="200"} 1' in error
+    assert "http_request{" in error
@@ -0,0 +1,117 @@
+"""Tests for the pooled HTTP client."""
+
+# pylint: skip-file
+
+import time
+
+import pytest
+import requests as req
+
+from postcode_client import AdaptiveLimit, PostcodeClient, TokenBucket
+from postcode_functions import (get_postcode_completions, get_postcode_for_location,
+                                get_postcodes_details, set_client, validate_postcode)
+from postcode_stub import StubServer, make_locations, make_postcodes
+
+
+@pytest.fixture()
+def stub_client():
+    with StubServer(make_postcodes(100)) as server:
+        client = PostcodeClient(base_url=server.url)
+        set_client(client)
+        yield server
+        set_client(None)
+        client.close()
+
+
+def test_functions_route_through_injected_client(stub_client):
+    postcodes = make_postcodes(100)
+    assert validate_postcode(postcodes[0]) is True
+    assert validate_postcode("ZZ99 9ZZ") is False
+    assert get_postcode_completions("AB1") == sorted(p for p in postcodes if p.startswith("AB1"))[:10]
+    lat, long = make_locations(postcodes)[postcodes[5]]
+    assert get_postcode_for_location(lat, long) == postcodes[5]
+    details = get_postcodes_details(postcodes[:2])
+    assert [item["result"]["postcode"] for item in details["result"]] == postcodes[:2]
+    assert stub_client.request_count == 5
+
+
+def test_client_uses_configured_timeout(requests_mock):
+    requests_mock.get("https://api.postcodes.io/postcodes/ABC/validate", json={"result": True})
+    client = PostcodeClient(timeout=(1, 2))
+    client.get("/postcodes/ABC/validate")
+    assert requests_mock.request_history[0].timeout == (1, 2)
+
+
+def test_client_retries_throttled_requests():
+    postcodes = make_postcodes(20)
+    with StubServer(postcodes, throttle_every=3) as server:
+        client = PostcodeClient(base_url=server.url)
+        results = [client.get(f"/postcodes/{p}/validate").json()["result"] for p in postcodes]
+        state = client.state()
+        client.close()
+    assert all(results)
+    assert server.throttled_count > 0
+    assert state["concurrency"]["throttled"] == server.throttled_count
+    assert state["concurrency"]["requests"] == server.request_count
+
+
+def test_throttling_pauses_for_retry_after():
+    with StubServer(make_postcodes(10), throttle_every=2, retry_after=0.2) as server:
+        client = PostcodeClient(base_url=server.url)
+        client.get("/postcodes/AB10AA/validate")
+        start = time.monotonic()
+        assert client.get("/postcodes/AB10AA/validate").status_code == 200
+        elapsed = time.monotonic() - start
+        client.close()
+    assert elapsed >= 0.2
+
+
+def test_throttling_halves_concurrency_limit():
+    limit = AdaptiveLimit(initial=8)
+    limit.acquire()
+    limit.release(0.01, throttled=True)
+    assert limit.state()["limit"] == 4
+    for _ in range(4):
+        limit.acquire()
+        limit.release(0.01)
+    assert limit.state()["limit"] == pytest.approx(5, abs=0.1)
+
+
+def test_token_bucket_limits_rate():
+    bucket = TokenBucket(rate=50, burst=1)
+    start = time.monotonic()
+    for _ in range(6):
+        bucket.acquire()
+    assert time.monotonic() - start >= 0.09
+
+
+def test_token_bucket_allows_rates_below_one_per_second(monkeypatch):
+    bucket = TokenBucket(rate=0.5)
+    bucket.acquire()
+    waits = []
+
+    def sleep(seconds):
+        waits.append(seconds)
+        bucket.tokens = 1
+
+    monkeypatch.setattr("postcode_client.time.sleep", sleep)
+    bucket.acquire()
+    assert len(waits) == 1 and 1.9 <= waits[0] <= 2
+
+
+@pytest.mark.parametrize("rate, burst", [(0, None), (-1, None), (1, 0), (1, -2)])
+def test_token_bucket_rejects_non_positive_rates_and_bursts(rate, burst):
+    with pytest.raises(ValueError):
+        TokenBucket(rate, burst)
+
+
+def test_persistent_throttling_raises(requests_mock):
+    requests_mock.get("https://api.postcodes.io/postcodes/ABC/validate", status_code=429,
+                      headers={"Retry-After": "0"})
+    set_client(PostcodeClient(retries=2))
+    try:
+        with pytest.raises(req.RequestException, match="rate limit"):
+            validate_postcode("ABC")
+    finally:
+        set_client(None)
+    assert requests_mock.call_count == 3
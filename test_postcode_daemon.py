@@ -0,0 +1,104 @@
+"""Tests for the postcode daemon and the CLI's use of it."""
+
+# pylint: skip-file
+
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+import requests as req
+
+from postcode_daemon import DaemonClient, DaemonUnavailable, answer, connect
+from postcode_stub import StubServer, make_postcodes
+
+
+@pytest.fixture()
+def daemon(tmp_path):
+    with StubServer(make_postcodes(100)) as server:
+        socket_path = str(tmp_path / "postcode.sock")
+        env = {**os.environ, "POSTCODE_API_URL": server.url,
+               "POSTCODE_DAEMON_SOCKET": socket_path}
+        process = subprocess.Popen([sys.executable, "postcode_daemon.py"], env=env)
+        for _ in range(100):
+            if os.path.exists(socket_path):
+                break
+            time.sleep(0.05)
+        yield server, env, socket_path
+        process.send_signal(signal.SIGTERM)
+        process.wait(timeout=10)
+        assert not os.path.exists(socket_path)
+
+
+def run_cli(arguments, env):
+    result = subprocess.run([sys.executable, "-W", "ignore", "postcode_cli.py", *arguments],
+                            capture_output=True, text=True, env=env)
+    return result.stdout, result.stderr
+
+
+def test_daemon_answers_lookups_and_reraises_errors(daemon):
+    server, _, socket_path = daemon
+    client = connect(socket_path)
+    assert client.call("validate_postcode", "AB1 0AA") is True
+    assert client.call("validate_postcode", "AB1 0AA") is True
+    assert client.call("validate_postcodes", ["AB1 0AA", "ZZ9 9ZZ"]) == {
+        "AB1 0AA": True, "ZZ9 9ZZ": False}
+    assert server.request_count == 2
+    with pytest.raises(TypeError, match="Function expects a string."):
+        client.call("validate_postcode", 5)
+
+
+def test_cli_uses_running_daemon(daemon):
+    server, env, _ = daemon
+    for _ in range(2):
+        output, error = run_cli(["-m", "validate", "AB1 0AA"], env)
+        assert output.strip() == "AB1 0AA is a valid postcode."
+        assert error == ""
+    assert server.request_count == 1
+
+
+def test_cli_falls_back_when_daemon_is_not_running(tmp_path):
+    socket_path = tmp_path / "postcode.sock"
+    socket_path.write_text("stale")
+    with StubServer(make_postcodes(10)) as server:
+        env = {**os.environ, "POSTCODE_API_URL": server.url,
+               "POSTCODE_DAEMON_SOCKET": str(socket_path)}
+        output, error = run_cli(["-m", "complete", "AB1 0A"], env)
+    assert output.strip() == "AB1 0AA"
+    assert error == ""
+
+
+def test_unreachable_daemon_raises(tmp_path):
+    assert connect(str(tmp_path / "missing.sock")) is None
+    with pytest.raises(DaemonUnavailable):
+        DaemonClient(str(tmp_path / "missing.sock")).call("validate_postcode", "AB1 0AA")
+
+
+def test_answer_rejects_unknown_functions_and_wraps_api_errors(requests_mock):
+    assert answer({"function": "save_cache", "args": [{}]})["error"] == "ValueError"
+    requests_mock.get("https://api.postcodes.io/postcodes/ABC/validate", status_code=500)
+    assert answer({"function": "validate_postcode", "args": ["ABC"]}) == {
+        "error": "RequestException", "message": "Unable to access API."}
+
+
+def test_slow_daemon_times_out_without_falling_back(tmp_path):
+    socket_path = str(tmp_path / "postcode.sock")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as listener:
+        listener.bind(socket_path)
+        listener.listen()
+        client = DaemonClient(socket_path, timeout=0.2)
+        with pytest.raises(req.RequestException) as error:
+            client.call("validate_postcode", "AB1 0AA")
+    assert not isinstance(error.value, DaemonUnavailable)
+
+
+def test_connect_ignores_sockets_it_does_not_own(tmp_path, monkeypatch):
+    socket_path = str(tmp_path / "postcode.sock")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as listener:
+        listener.bind(socket_path)
+        assert connect(socket_path) is not None
+        monkeypatch.setattr(os, "getuid", lambda: os.stat(socket_path).st_uid + 1)
+        assert connect(socket_path) is None
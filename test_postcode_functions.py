@@ -2,11 +2,17 @@
 
 # pylint: skip-file
 
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import pytest
 import requests as req
 
-from postcode_functions import (get_postcode_completions, get_postcode_for_location,
-                                get_postcodes_details, validate_postcode)
+from postcode_functions import (CACHE_TTLS, ERROR_TTL, NEGATIVE_TTLS, SINGLE_FLIGHT,
+                                STALE_TTLS, SingleFlight, get_postcode_completions,
+                                get_postcode_for_location, get_postcodes_details, save_cache,
+                                validate_postcode, validate_postcodes)
+from postcode_index import UK_POSTCODE
 
 
 ## Validate tests
@@ -180,3 +186,158 @@ def test_get_postcodes_details_returns_response_dict(requests_mock):
     assert response == {"response": "value"}
 
 
+
+
+# Bulk validation tests
+
+
+def test_validate_postcodes_rejects_non_strings():
+    with pytest.raises(TypeError, match="Function expects a list of strings."):
+        validate_postcodes(["AB1 1AA", 42])
+
+
+def test_validate_postcodes_uses_cache_and_bulk_lookup(requests_mock):
+    requests_mock.get("https://api.postcodes.io/postcodes/CACHED/validate",
+                      status_code=200, json={"result": True})
+    validate_postcode("CACHED")
+    requests_mock.post("https://api.postcodes.io/postcodes", json={"result": [
+        {"query": "GOOD", "result": {"postcode": "GOOD"}},
+        {"query": "BAD", "result": None}]})
+    result = validate_postcodes(["BAD", "CACHED", "GOOD", "BAD"])
+    assert result == {"BAD": False, "CACHED": True, "GOOD": True}
+    assert list(result) == ["BAD", "CACHED", "GOOD"]
+    assert requests_mock.request_history[-1].json() == {"postcodes": ["BAD", "GOOD"]}
+    requests_mock.reset_mock()
+    assert validate_postcodes(["GOOD", "BAD"]) == {"GOOD": True, "BAD": False}
+    assert requests_mock.call_count == 0
+
+
+def test_validate_postcodes_chunks_requests(requests_mock):
+    postcodes = [f"PC{i}" for i in range(250)]
+    requests_mock.post("https://api.postcodes.io/postcodes", json={"result": []})
+    result = validate_postcodes(postcodes)
+    assert requests_mock.call_count == 3
+    assert sorted(len(call.json()["postcodes"]) for call in requests_mock.request_history) == [50, 100, 100]
+    assert list(result) == postcodes
+
+
+def test_validate_postcodes_raises_exception_with_500_codes(requests_mock):
+    requests_mock.post("https://api.postcodes.io/postcodes", status_code=500)
+    with pytest.raises(req.RequestException, match="Unable to access API."):
+        validate_postcodes(["ABC"])
+
+
+# Single-flight tests
+
+
+def test_concurrent_validations_share_one_request(requests_mock):
+    release = threading.Event()
+
+    def slow_reply(request, context):
+        release.wait(5)
+        return {"result": True}
+
+    requests_mock.get("https://api.postcodes.io/postcodes/TN12 0AA/validate", json=slow_reply)
+    before = SINGLE_FLIGHT.stats()
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        futures = [executor.submit(validate_postcode, "TN12 0AA") for _ in range(5)]
+        while SINGLE_FLIGHT.stats()["calls"] - before["calls"] < 5:
+            time.sleep(0.01)
+        release.set()
+        assert [future.result() for future in futures] == [True] * 5
+    assert requests_mock.call_count == 1
+    assert SINGLE_FLIGHT.stats()["coalesced"] - before["coalesced"] == 4
+
+
+def test_single_flight_shares_exceptions():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def failing():
+        started.set()
+        release.wait(5)
+        raise req.RequestException("Unable to access API.")
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        leader = executor.submit(flight.do, "key", failing)
+        started.wait(5)
+        follower = executor.submit(flight.do, "key", lambda: pytest.fail("called twice"))
+        while flight.stats()["coalesced"] == 0:
+            time.sleep(0.01)
+        release.set()
+        for future in (leader, follower):
+            with pytest.raises(req.RequestException, match="Unable to access API."):
+                future.result()
+    assert flight.stats() == {"calls": 2, "executed": 1, "coalesced": 1}
+
+
+# Format checks and negative caching
+
+
+@pytest.mark.parametrize("postcode", ["", "AB1 0AA!", "TOO LONG POSTCODE", "ÄB1 0AA"])
+def test_validate_postcode_rejects_implausible_postcodes_without_a_request(postcode,
+                                                                           requests_mock):
+    assert validate_postcode(postcode) is False
+    assert validate_postcodes([postcode]) == {postcode: False}
+    assert get_postcode_completions(postcode) is None
+    assert requests_mock.call_count == 0
+
+
+def test_validate_postcode_checks_the_configured_format(requests_mock, monkeypatch):
+    monkeypatch.setattr("postcode_functions.POSTCODE_FORMAT", UK_POSTCODE)
+    requests_mock.get("https://api.postcodes.io/postcodes/AB1 0AA/validate",
+                      status_code=200, json={"result": True})
+    assert validate_postcode("ABC") is False
+    assert validate_postcode("AB10AA")
+    assert requests_mock.call_count == 1
+
+
+def test_get_postcode_completions_caches_no_completions(requests_mock):
+    requests_mock.get("https://api.postcodes.io/postcodes/ZZ9/autocomplete",
+                      status_code=200, json={"result": None})
+    assert get_postcode_completions("ZZ9") is None
+    assert get_postcode_completions("ZZ9") is None
+    assert requests_mock.call_count == 1
+
+
+def test_validate_postcode_caches_unknown_answers_until_they_expire(requests_mock,
+                                                                    monkeypatch):
+    requests_mock.get("https://api.postcodes.io/postcodes/ZZ9 9ZZ/validate", status_code=404)
+    assert validate_postcode("ZZ99ZZ") is None
+    assert validate_postcode("ZZ99ZZ") is None
+    assert requests_mock.call_count == 1
+    later = time.time() + NEGATIVE_TTLS["valid"] + 1
+    monkeypatch.setattr(time, "time", lambda: later)
+    validate_postcode("ZZ99ZZ")
+    assert requests_mock.call_count == 2
+
+
+def test_validate_postcode_rechecks_answers_older_than_their_ttl(requests_mock):
+    requests_mock.get("https://api.postcodes.io/postcodes/AB1 0AA/validate",
+                      status_code=200, json={"result": False})
+    long_ago = time.time() - CACHE_TTLS["valid"] - STALE_TTLS["valid"] - 1
+    save_cache({"AB1 0AA": {"valid": True, "valid_at": long_ago}})
+    assert validate_postcode("AB1 0AA") is False
+    assert requests_mock.call_count == 1
+
+
+def test_validate_postcodes_counts_cached_unknown_answers_as_invalid(requests_mock):
+    requests_mock.get("https://api.postcodes.io/postcodes/ZZ9 9ZZ/validate", status_code=404)
+    assert validate_postcode("ZZ9 9ZZ") is None
+    assert validate_postcodes(["ZZ9 9ZZ"]) == {"ZZ9 9ZZ": False}
+    assert requests_mock.call_count == 1
+
+
+def test_validate_postcode_caches_api_errors_briefly(requests_mock, monkeypatch):
+    requests_mock.get("https://api.postcodes.io/postcodes/AB1 0AA/validate", status_code=503)
+    for _ in range(2):
+        with pytest.raises(req.RequestException, match="Unable to access API."):
+            validate_postcode("AB10AA")
+    assert requests_mock.call_count == 1
+    later = time.time() + ERROR_TTL + 1
+    monkeypatch.setattr(time, "time", lambda: later)
+    requests_mock.get("https://api.postcodes.io/postcodes/AB1 0AA/validate",
+                      status_code=200, json={"result": True})
+    assert validate_postcode("AB10AA")
+    assert requests_mock.call_count == 2
@@ -0,0 +1,134 @@
+"""Tests for the offline spatial index of postcodes."""
+
+# pylint: skip-file
+
+import time
+import pytest
+import requests as req
+
+from postcode_cache import JsonCacheStore, LocationCache
+from postcode_functions import (get_postcode_for_location, get_postcodes_for_locations, load_cache,
+                                set_geo_index)
+from postcode_geo import GeoIndex, distance, read_centroids
+
+CENTROIDS = [("SW1A 1AA", 51.501009, -0.141588),
+             ("SW1A 2AA", 51.503540, -0.127695),
+             ("EH14 2AA", 55.911245, -3.275521)]
+
+
+@pytest.fixture()
+def geo_index():
+    index = GeoIndex(CENTROIDS)
+    set_geo_index(index)
+    yield index
+    set_geo_index(None)
+
+
+def test_distance_matches_known_separation():
+    assert distance(51.501009, -0.141588, 51.503540, -0.127695) == pytest.approx(1000, rel=0.01)
+
+
+def test_nearest_returns_postcodes_within_radius_nearest_first(geo_index):
+    assert geo_index.nearest(51.5011, -0.1416) == [("SW1A 1AA", pytest.approx(10, abs=2))]
+    assert [p for p, _ in geo_index.nearest(51.5011, -0.1416, radius=2000)] == ["SW1A 1AA",
+                                                                                 "SW1A 2AA"]
+    assert geo_index.nearest(51.5011, -0.1416, radius=2000, limit=1)[0][0] == "SW1A 1AA"
+    assert geo_index.nearest(53.0, -1.0, radius=2000) == []
+
+
+def test_nearest_many_keeps_input_order(geo_index):
+    results = geo_index.nearest_many([(55.9112, -3.2755), (0.0, 0.0), (51.5035, -0.1277)])
+    assert [[p for p, _ in result] for result in results] == [["EH14 2AA"], [], ["SW1A 2AA"]]
+
+
+def test_read_centroids_skips_terminated_and_unlocated_rows(tmp_path):
+    path = tmp_path / "onspd.csv"
+    path.write_text("pcds,doterm,lat,long\nSW1A 1AA,,51.501009,-0.141588\n"
+                    "SW1A 1AB,200101,51.5,-0.14\nGY1 1AA,,99.999999,0.000000\n")
+    assert list(read_centroids(str(path))) == [("SW1A 1AA", 51.501009, -0.141588)]
+
+
+def test_get_postcode_for_location_answers_offline(geo_index, requests_mock):
+    requests_mock.get("https://api.postcodes.io/postcodes?lon=1.0&lat=2.0",
+                      status_code=200, json={"result": [{"postcode": "FAR"}]})
+    assert get_postcode_for_location(51.5011, -0.1416) == "SW1A 1AA"
+    assert get_postcode_for_location(2.0, 1.0) == "FAR"
+    assert requests_mock.call_count == 1
+
+
+def test_get_postcode_for_location_caches_quantised_coordinates(requests_mock):
+    requests_mock.get("https://api.postcodes.io/postcodes", status_code=200,
+                      json={"result": [{"postcode": "SW1A 1AA"}]})
+    assert get_postcode_for_location(51.50101, -0.14159) == "SW1A 1AA"
+    assert get_postcode_for_location(51.50099, -0.14161) == "SW1A 1AA"
+    assert requests_mock.call_count == 1
+    assert load_cache()["@51.5010,-0.1416"]["nearest"] == "SW1A 1AA"
+
+
+def test_location_cache_expires_and_evicts_entries(tmp_path, monkeypatch):
+    store = JsonCacheStore(str(tmp_path / "cache.json"))
+    cache = LocationCache(store, ttl=60, max_entries=2)
+    for lat in (1.0, 2.0, 3.0):
+        cache.put(lat, 0.0, [{"postcode": f"P{lat}"}])
+    assert cache.get(1.0, 0.0) is None
+    assert cache.get(3.0, 0.0) == "P3.0"
+    assert sorted(store.load()) == ["@2.0000,0.0000", "@3.0000,0.0000"]
+    monkeypatch.setattr(time, "time", lambda: time.monotonic() + 10**10)
+    assert cache.get(3.0, 0.0) is None
+
+
+def test_location_cache_limits_entries_left_by_earlier_runs(tmp_path):
+    store = JsonCacheStore(str(tmp_path / "cache.json"))
+    now = time.time()
+    store.save({"@1.0000,0.0000": {"nearest": "OLD", "fetched_at": now - 10**6},
+                "@2.0000,0.0000": {"nearest": "P2", "fetched_at": now - 20},
+                "@3.0000,0.0000": {"nearest": "P3", "fetched_at": now - 10},
+                "AB1 0AA": {"valid": True}})
+    LocationCache(store, ttl=60, max_entries=2).put(4.0, 0.0, [{"postcode": "P4"}])
+    assert sorted(store.load()) == ["@3.0000,0.0000", "@4.0000,0.0000", "AB1 0AA"]
+
+
+def test_location_cache_answers_nearby_queries_from_full_results(tmp_path):
+    cache = LocationCache(JsonCacheStore(str(tmp_path / "cache.json")), keep_results=True)
+    results = [{"postcode": "SW1A 1AA", "latitude": 51.501009, "longitude": -0.141588,
+                "distance": 5},
+               {"postcode": "SW1A 1AB", "latitude": 51.501500, "longitude": -0.141588,
+                "distance": 50}]
+    cache.put(51.50140, -0.14159, results)
+    assert cache.get(51.50150, -0.14159) == "SW1A 1AB"
+    assert cache.get(51.50131, -0.14159) == "SW1A 1AB"
+    assert cache.get(51.50120, -0.14159) is None
+
+
+def test_get_postcodes_for_locations_keeps_order_and_per_point_errors(requests_mock):
+    requests_mock.post("https://api.postcodes.io/postcodes", json={"result": [
+        {"query": {}, "result": [{"postcode": "NEAR"}]},
+        {"query": {}, "result": None}]})
+    results = get_postcodes_for_locations([(51.5, -0.1), ("x", 1.0), (0.0, 0.0), (1, 2, 3)])
+    assert results[0] == "NEAR"
+    assert isinstance(results[1], TypeError)
+    assert isinstance(results[2], ValueError)
+    assert str(results[2]) == "No relevant postcode found."
+    assert isinstance(results[3], TypeError)
+    assert requests_mock.request_history[0].json() == {"geolocations": [
+        {"latitude": 51.5, "longitude": -0.1}, {"latitude": 0.0, "longitude": 0.0}]}
+    requests_mock.reset_mock()
+    assert get_postcodes_for_locations([(51.5, -0.1)]) == ["NEAR"]
+    assert requests_mock.call_count == 0
+
+
+def test_get_postcodes_for_locations_chunks_requests(requests_mock):
+    def reply(request, context):
+        return {"result": [{"query": point, "result": [{"postcode": f"{point['latitude']}"}]}
+                           for point in request.json()["geolocations"]]}
+
+    requests_mock.post("https://api.postcodes.io/postcodes", json=reply)
+    points = [(float(i), 0.0) for i in range(250)]
+    assert get_postcodes_for_locations(points) == [str(float(i)) for i in range(250)]
+    assert requests_mock.call_count == 3
+
+
+def test_get_postcodes_for_locations_raises_exception_with_500_codes(requests_mock):
+    requests_mock.post("https://api.postcodes.io/postcodes", status_code=500)
+    with pytest.raises(req.RequestException, match="Unable to access API."):
+        get_postcodes_for_locations([(1.0, 2.0)])
@@ -0,0 +1,108 @@
+"""Tests for the offline postcode index."""
+
+# pylint: skip-file
+
+import pytest
+
+from postcode_functions import (get_postcode_completions, set_offline_index, validate_postcode,
+                                validate_postcodes)
+from postcode_index import PostcodeIndex, build_index, canonical, read_postcodes
+
+
+@pytest.fixture()
+def index(tmp_path):
+    path = str(tmp_path / "index.bin")
+    build_index(["TN12 0AA", "sw1a 1aa", "EH14 2AA", "TN12 0AA", "not a postcode"], path)
+    index = PostcodeIndex(path)
+    set_offline_index(index)
+    yield index
+    set_offline_index(None)
+    index.close()
+
+
+def test_index_contains_normalised_postcodes(index):
+    assert len(index) == 3
+    assert "TN12 0AA" in index
+    assert "tn120aa" in index
+    assert "SW1A 1AA" in index
+    assert "TN12 0AB" not in index
+    assert "" not in index
+
+
+def test_read_postcodes_skips_terminated_rows(tmp_path):
+    path = tmp_path / "onspd.csv"
+    path.write_text("pcd,pcds,doterm\nTN120AA,TN12 0AA,\nTN120AB,TN12 0AB,200101\n")
+    assert list(read_postcodes(str(path))) == ["TN12 0AA"]
+
+
+def test_read_postcodes_uses_first_column_without_header(tmp_path):
+    path = tmp_path / "codepoint.csv"
+    path.write_text('"TN12 0AA",10\n"TN12 0AB",10\n')
+    assert list(read_postcodes(str(path))) == ["TN12 0AA", "TN12 0AB"]
+
+
+def test_index_rejects_other_files(tmp_path):
+    path = tmp_path / "other.bin"
+    path.write_bytes(b"\0" * 32)
+    with pytest.raises(ValueError, match="Not a postcode index file."):
+        PostcodeIndex(str(path))
+
+
+def test_validate_postcode_answers_indexed_postcodes_offline(index, requests_mock):
+    requests_mock.get("https://api.postcodes.io/postcodes/ZZ1 1ZZ/validate",
+                      status_code=200, json={"result": False})
+    assert validate_postcode("EH14 2AA") is True
+    assert validate_postcode("ZZ1 1ZZ") is False
+    assert requests_mock.call_count == 1
+
+
+def test_validate_postcodes_answers_indexed_postcodes_offline(index, requests_mock):
+    requests_mock.post("https://api.postcodes.io/postcodes",
+                       json={"result": [{"query": "ZZ1 1ZZ", "result": None}]})
+    assert validate_postcodes(["TN12 0AA", "ZZ1 1ZZ"]) == {"TN12 0AA": True, "ZZ1 1ZZ": False}
+    assert requests_mock.request_history[0].json() == {"postcodes": ["ZZ1 1ZZ"]}
+
+
+def test_index_completes_prefixes_in_sorted_order(index):
+    assert index.complete("TN1") == ["TN12 0AA"]
+    assert index.complete("tn12 0") == ["TN12 0AA"]
+    assert index.complete("") == []
+    assert index.complete("ZZ") == []
+    assert index.complete("E", limit=0) == []
+
+
+def test_get_postcode_completions_answers_indexed_prefixes_offline(index, requests_mock):
+    requests_mock.get("https://api.postcodes.io/postcodes/ZZ/autocomplete",
+                      status_code=200, json={"result": None})
+    assert get_postcode_completions("SW1") == ["SW1A 1AA"]
+    assert get_postcode_completions("ZZ") is None
+    assert requests_mock.call_count == 1
+
+
+def test_get_postcode_completions_filters_complete_parent_results(requests_mock):
+    requests_mock.get("https://api.postcodes.io/postcodes/TN1/autocomplete",
+                      status_code=200, json={"result": ["TN1 1AA", "TN12 0AB", "TN12 0AA"]})
+    get_postcode_completions("TN1")
+    requests_mock.reset_mock()
+    assert get_postcode_completions("TN12") == ["TN12 0AA", "TN12 0AB"]
+    assert get_postcode_completions("TN12 0A") == ["TN12 0AA", "TN12 0AB"]
+    assert get_postcode_completions("TN13") is None
+    assert requests_mock.call_count == 0
+
+
+def test_get_postcode_completions_calls_api_below_capped_parent(requests_mock):
+    parent = [f"TN1 {i}AA" for i in range(10)]
+    requests_mock.get("https://api.postcodes.io/postcodes/TN1/autocomplete",
+                      status_code=200, json={"result": parent})
+    requests_mock.get("https://api.postcodes.io/postcodes/TN12/autocomplete",
+                      status_code=200, json={"result": ["TN12 0AA"]})
+    get_postcode_completions("TN1")
+    assert get_postcode_completions("TN12") == ["TN12 0AA"]
+    assert requests_mock.call_count == 2
+
+
+@pytest.mark.parametrize("postcode, expected", [
+    ("tn120aa", "TN12 0AA"), (" TN12  0aa ", "TN12 0AA"), ("tn1 20aa", "TN12 0AA"),
+    ("gir0aa", "GIR 0AA"), ("tn12  0", "TN12 0"), ("tn120", "TN120"), ("valid1", "VALID1")])
+def test_canonical_shares_one_spelling(postcode, expected):
+    assert canonical(postcode) == expected
@@ -0,0 +1,70 @@
+"""Tests for the instrumentation hooks."""
+
+# pylint: skip-file
+
+import logging
+
+import pytest
+
+import postcode_metrics as metrics
+from postcode_functions import load_cache, save_cache, validate_postcode
+
+
+@pytest.fixture()
+def sink():
+    sink = metrics.MemorySink()
+    metrics.set_sink(sink)
+    yield sink
+    metrics.set_sink(None)
+
+
+def test_disabled_timer_is_shared_no_op():
+    assert metrics.get_sink() is None
+    assert metrics.timed("anything") is metrics.NULL_TIMER
+    metrics.count("anything")
+
+
+def test_cache_hits_misses_and_status_codes(sink, requests_mock):
+    requests_mock.get("https://api.postcodes.io/postcodes/ABC/validate", json={"result": True})
+    assert validate_postcode("ABC") is True
+    assert validate_postcode("ABC") is True
+    assert sink.value("cache_misses", field="valid") == 1
+    assert sink.value("cache_hits", field="valid") == 1
+    assert sink.value("http_responses", status=200) == 1
+    assert sink.calls("http_request", method="GET") == 1
+
+
+def test_load_and_save_record_timings_and_bytes(sink):
+    save_cache({"ABC": {"valid": True}})
+    assert load_cache() == {"ABC": {"valid": True}}
+    assert sink.calls("save_cache") == 1
+    assert sink.calls("load_cache") == 1
+    assert sink.calls("cache_parse") == 1
+    assert sink.value("cache_bytes_written") == sink.value("cache_bytes_read") > 0
+
+
+def test_prometheus_sink_renders_text_format():
+    sink = metrics.PrometheusSink()
+    sink.count("http_responses", 2, {"status": 200})
+    sink.count("http_responses", 1, {"status": 500})
+    sink.observe("load_cache", 0.5, {})
+    assert sink.render() == (
+        "# TYPE postcode_http_responses_total counter\n"
+        'postcode_http_responses_total{status="200"} 2\n'
+        'postcode_http_responses_total{status="500"} 1\n'
+        "# TYPE postcode_load_cache_seconds summary\n"
+        "postcode_load_cache_seconds_count 1\n"
+        "postcode_load_cache_seconds_sum 0.500000\n")
+
+
+def test_logging_sink_logs_each_event(caplog):
+    metrics.set_sink(metrics.LoggingSink())
+    try:
+        with caplog.at_level(logging.DEBUG, logger="postcode.metrics"):
+            metrics.count("cache_hits", field="valid")
+            with metrics.timed("load_cache"):
+                pass
+    finally:
+        metrics.set_sink(None)
+    assert 'cache_hits{field="valid"} +1' in caplog.text
+    assert "load_cache " in caplog.text
@@ -0,0 +1,48 @@
+"""Tests for warming the cache by outward code."""
+
+# pylint: skip-file
+
+import pytest
+
+from postcode_client import PostcodeClient
+from postcode_functions import (get_postcode_completions, get_postcodes_details, load_cache,
+                                set_client, validate_postcode)
+from postcode_stub import StubServer, make_postcodes
+from postcode_warm import in_area, warm_cache
+
+
+@pytest.fixture()
+def server():
+    with StubServer(make_postcodes(400)) as server:
+        client = PostcodeClient(base_url=server.url)
+        set_client(client)
+        yield server
+        set_client(None)
+        client.close()
+
+
+@pytest.mark.parametrize("postcode, area, expected", [
+    ("AB1 0AA", "AB1", True), ("AB10 0AA", "AB1", False), ("AB10 0AA", "AB", True),
+    ("A1 0AA", "AB", False)])
+def test_in_area_matches_outward_codes_and_areas(postcode, area, expected):
+    assert in_area(postcode, area) is expected
+
+
+def test_warm_cache_caches_every_postcode_in_an_outward_code(server):
+    progress = []
+    assert warm_cache(["ab1"], lambda *args: progress.append(args)) == {"AB1": 2}
+    assert progress == [("AB1", 0, 2), ("AB1", 2, 2)]
+    cache = load_cache()
+    assert cache["AB1 0AA"]["valid"] and cache["AB1 1AA"]["details"]["outcode"] == "AB1"
+    requests = server.request_count
+    assert validate_postcode("ab10aa")
+    assert get_postcodes_details(["AB1 1AA"])["result"][0]["result"]["incode"] == "1AA"
+    assert get_postcode_completions("AB1") is not None
+    assert server.request_count == requests
+
+
+def test_warm_cache_resumes_without_repeating_lookups(server):
+    warm_cache(["AB"])
+    requests = server.request_count
+    assert warm_cache(["AB"]) == {"AB": 40}
+    assert server.request_count == requests